@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the lyrics analysis pipeline.
+
+Each stage of Lyrics is timed separately (reading the file, clean_text,
+loading/computing the transcription, computing the vowel representation,
+rhyme_stats and get_rhyme_str) for synthetic lyrics of different sizes and
+for the bundled corpora. The memory used by an analyzed Lyrics object is
+measured for the corpora (both in the default and in the lean mode). With
+--server, the latency of scoring a verse with the scoring daemon is
+compared to the cold command line path. With --word-dict, transcribing the
+English corpus word by word (phonetics.WordPhonemeDict) is timed with an
+empty and a filled dictionary and compared to the whole-text transcriptions
+(hit rate of the dictionary and the differences). The results are written
+as JSON so that two commits can be compared:
+
+    python benchmark.py -o before.json
+    (change something)
+    python benchmark.py -o after.json
+    python benchmark.py --compare before.json after.json
+'''
+
+import argparse
+import codecs
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import datetime as dt
+from timeit import default_timer as timer
+
+import numpy as np
+
+from lyrics import Lyrics
+import raplyzer
+
+STAGES = ['read', 'clean_text', 'transcription', 'vowel_representation',
+          'rhyme_stats', 'get_rhyme_str']
+
+FI_CONSONANTS = u'hjklmnprstv'
+FI_VOWELS = u'aeiouyäö'
+# eSpeak vowels (see phonetics.is_vow) and some letters to spell them with
+EN_VOWELS = [(u'a', u'a'), (u'E', u'e'), (u'I', u'i'), (u'i:', u'ee'),
+             (u'0', u'o'), (u'V', u'u'), (u'u:', u'oo'), (u'aI', u'ai'),
+             (u'eI', u'ay'), (u'oU', u'oa'), (u'3:', u'ur'), (u'aU', u'ow')]
+EN_CONSONANTS = [(u'b', u'b'), (u'd', u'd'), (u'f', u'f'), (u'g', u'g'),
+                 (u'k', u'k'), (u'l', u'l'), (u'm', u'm'), (u'n', u'n'),
+                 (u'p', u'p'), (u'r', u'r'), (u's', u's'), (u't', u't'),
+                 (u'D', u'th'), (u'S', u'sh'), (u'tS', u'ch'), (u'w', u'w')]
+
+class SyntheticLyrics:
+    '''
+    Generator of synthetic Finnish lyrics or English lyrics with a matching
+    phonetic transcription.
+
+    Input:
+        language        'fi' or 'en-us'.
+        vocabulary      Number of distinct words.
+        rhyme_density   Probability that a line ends with a word that rhymes
+                        with the end of the previous line.
+        repetition      Probability that a line repeats an earlier line.
+    '''
+
+    def __init__(self, language='fi', vocabulary=2000, rhyme_density=0.5,
+                 repetition=0.1, seed=0):
+        self.language = language
+        self.rhyme_density = rhyme_density
+        self.repetition = repetition
+        self.rnd = random.Random(seed)
+        # Each word is a list of (phonemes, spelling) syllables
+        self.words = [self._word() for i in range(vocabulary)]
+
+    def _syllable(self, vowel=None):
+        if self.language == 'fi':
+            if vowel is None:
+                vowel = self.rnd.choice(FI_VOWELS)
+            c = self.rnd.choice(FI_CONSONANTS)
+            return (c + vowel, c + vowel)
+        if vowel is None:
+            vowel = self.rnd.choice(EN_VOWELS)
+        c = self.rnd.choice(EN_CONSONANTS)
+        return (c[0] + vowel[0], c[1] + vowel[1])
+
+    def _vowel(self, syllable):
+        if self.language == 'fi':
+            return syllable[0][-1]
+        for v in EN_VOWELS:
+            if syllable[0].endswith(v[0]) and syllable[1].endswith(v[1]):
+                return v
+        return None
+
+    def _word(self, rhymes_with=None):
+        n = self.rnd.randint(1, 3)
+        if rhymes_with is None:
+            return [self._syllable() for i in range(n)]
+        # Same vowels (but most likely different consonants)
+        return [self._syllable(self._vowel(s)) for s in rhymes_with]
+
+    def song(self, n_lines=40, words_per_line=8):
+        '''
+        Output:
+            Tuple (text, transcription) where transcription is the phonetic
+            transcription of each line (None for Finnish).
+        '''
+        lines = []
+        for i in range(n_lines):
+            if len(lines) > 0 and self.rnd.random() < self.repetition:
+                lines.append(self.rnd.choice(lines))
+                continue
+            line = [self.rnd.choice(self.words)
+                    for j in range(self.rnd.randint(1, 2*words_per_line-1))]
+            if len(lines) > 0 and self.rnd.random() < self.rhyme_density:
+                line[-1] = self._word(rhymes_with=lines[-1][-1])
+            lines.append(line)
+        text = u'\n'.join(u' '.join(u''.join(s[1] for s in w) for w in line)
+                          for line in lines)
+        if self.language == 'fi':
+            return text, None
+        phonetic = [u' ' + u' '.join(u''.join(s[0] for s in w) for w in line)
+                    for line in lines]
+        return text.capitalize(), phonetic
+
+    def write_song(self, fname, n_lines=40, words_per_line=8):
+        '''
+        Write a song (and the transcription of its cleaned lines to
+        <fname>.ipa for English).
+        '''
+        text, phonetic = self.song(n_lines, words_per_line)
+        f = codecs.open(fname, 'w', 'utf8')
+        f.write(text)
+        f.close()
+        if phonetic is None:
+            return
+        # Transcription of the cleaned text (duplicate lines are removed)
+        l = Lyrics(language=self.language)
+        transcription = []
+        seen = set()
+        for line, ph_line in zip(text.split(u'\n'), phonetic):
+            key = l._substitute(line).strip()
+            if key not in seen:
+                seen.add(key)
+                transcription.append(ph_line)
+        f = codecs.open(fname + '.ipa', 'w', 'utf8')
+        f.write(u'\n'.join(transcription) + u'\n')
+        f.close()
+
+def time_song(fname, language, lookback, engine='loop'):
+    '''
+    Run the stages of Lyrics separately for a song and time them (the
+    stages are run lazily when their results are accessed).
+
+    Output:
+        Dict from stage names to seconds, and the number of words.
+    '''
+    times = {}
+    t0 = timer()
+    l = Lyrics(fname, language=language, lookback=lookback, engine=engine)
+    t1 = timer()
+    times['read'] = t1 - t0
+
+    l.lines
+    t2 = timer()
+    times['clean_text'] = t2 - t1
+
+    l.text
+    t3 = timer()
+    times['transcription'] = t3 - t2
+
+    l.vow
+    t4 = timer()
+    times['vowel_representation'] = t4 - t3
+
+    l.avg_rhyme_length
+    t5 = timer()
+    times['rhyme_stats'] = t5 - t4
+
+    l.get_longest_rhyme()
+    t6 = timer()
+    times['get_rhyme_str'] = t6 - t5
+    return times, len(l.words)
+
+def time_songs(fnames, language, lookback, engine='loop', repeats=3):
+    '''
+    Total time of each stage over the songs (the minimum over the repeats).
+    '''
+    best = None
+    for r in range(repeats):
+        totals = dict((s, 0.0) for s in STAGES)
+        n_words = 0
+        for fname in fnames:
+            times, n = time_song(fname, language, lookback, engine)
+            n_words += n
+            for s in STAGES:
+                totals[s] += times[s]
+        if best is None:
+            best = totals
+        else:
+            for s in STAGES:
+                best[s] = min(best[s], totals[s])
+    best['total'] = sum(best[s] for s in STAGES)
+    return {'songs': len(fnames), 'words': n_words, 'seconds': best}
+
+def corpus_files(lyrics_dir):
+    return [fname for a, albums in raplyzer.list_songs(lyrics_dir)
+            for al, songs in albums for fname in songs]
+
+def run_benchmarks(line_counts=(20, 80, 320), lookbacks=(5, 10, 15, 30),
+                   engines=('loop', 'numpy'), n_songs=10, repeats=3,
+                   rhyme_density=0.5, repetition=0.1, corpora=True):
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix='raplyzer_bench_')
+    try:
+        for language in ('fi', 'en-us'):
+            gen = SyntheticLyrics(language, rhyme_density=rhyme_density,
+                                  repetition=repetition)
+            for n_lines in line_counts:
+                fnames = []
+                for i in range(n_songs):
+                    fname = os.path.join(temp_dir, '%s_%d_%d.txt' %
+                                         (language, n_lines, i))
+                    gen.write_song(fname, n_lines)
+                    fnames.append(fname)
+                for lookback in lookbacks:
+                    for engine in engines:
+                        res = time_songs(fnames, language, lookback, engine,
+                                         repeats)
+                        res.update({'corpus': 'synthetic',
+                                    'language': language,
+                                    'lines': n_lines, 'lookback': lookback,
+                                    'engine': engine})
+                        results.append(res)
+                        print_result(res)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if corpora:
+        for lyrics_dir, language, lookback in [('lyrics', 'fi', 10),
+                                               ('lyrics_en', 'en-us', 15)]:
+            if not os.path.isdir(lyrics_dir):
+                continue
+            for engine in engines:
+                res = time_songs(corpus_files(lyrics_dir), language, lookback,
+                                 engine, repeats)
+                res.update({'corpus': lyrics_dir, 'language': language,
+                            'lines': None, 'lookback': lookback,
+                            'engine': engine})
+                results.append(res)
+                print_result(res)
+    return results
+
+def deep_size(obj, seen=None):
+    '''
+    Approximate memory usage of obj in bytes including the objects it refers
+    to (objects referred to several times are counted once).
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        if obj.base is not None and not isinstance(obj, np.memmap):
+            size += obj.nbytes
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deep_size(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def song_memory(fnames, language, lookback, lean=False):
+    '''
+    Average memory usage (bytes) of an analyzed Lyrics object.
+    '''
+    sizes = []
+    for fname in fnames:
+        l = Lyrics(fname, language=language, lookback=lookback, lean=lean)
+        l.analyze()
+        sizes.append(deep_size(l))
+    return float(np.mean(sizes))
+
+def run_memory_benchmarks():
+    results = []
+    for lyrics_dir, language, lookback in [('lyrics', 'fi', 10),
+                                           ('lyrics_en', 'en-us', 15)]:
+        if not os.path.isdir(lyrics_dir):
+            continue
+        fnames = corpus_files(lyrics_dir)
+        res = {'corpus': lyrics_dir, 'language': language, 'songs': len(fnames)}
+        for mode, lean in [('default', False), ('lean', True)]:
+            res[mode] = song_memory(fnames, language, lookback, lean)
+        results.append(res)
+        print '%-10s %-6s memory per song: %.1f kB (lean %.1f kB)' % (
+                lyrics_dir, language, res['default'] / 1024.,
+                res['lean'] / 1024.)
+    return results
+
+def verses(lyrics_dir, n_lines=8):
+    '''
+    The first n_lines lines of each song of a corpus.
+    '''
+    texts = []
+    for fname in corpus_files(lyrics_dir):
+        f = codecs.open(fname, 'r', 'utf8')
+        texts.append(u'\n'.join(f.read().split(u'\n')[:n_lines]))
+        f.close()
+    return texts
+
+def run_server_benchmarks(lyrics_dir='lyrics', language='fi', n_verses=10):
+    '''
+    Compare the latency of scoring a verse with the cold command line path
+    (a new Python process analyzes the verse), with the command line client
+    of the scoring daemon and with a connected ScoringClient. The verses are
+    scored twice by the client so that the second round hits the result
+    cache of the daemon.
+    '''
+    import scoring_server
+    texts = verses(lyrics_dir)[:n_verses]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'scoring_server.py')
+    temp_dir = tempfile.mkdtemp(prefix='raplyzer_bench_')
+    socket_path = os.path.join(temp_dir, 'scoring.sock')
+    server = subprocess.Popen([sys.executable, script, 'serve', '--socket',
+                               socket_path])
+    try:
+        while not os.path.exists(socket_path):
+            if server.poll() is not None:
+                raise Exception("The scoring daemon failed to start")
+            time.sleep(0.05)
+
+        def run_cli(extra_args, text):
+            p = subprocess.Popen([sys.executable, script, 'score', '-l',
+                                  language] + extra_args,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            out = p.communicate(text.encode('utf8'))[0]
+            if p.returncode != 0:
+                raise Exception("Scoring failed: %s" % extra_args)
+            return json.loads(out)
+
+        times = dict((mode, []) for mode in
+                     ['cold_cli', 'warm_cli', 'warm_client', 'cached_client'])
+        client = scoring_server.ScoringClient(socket_path)
+        for text in texts:
+            start = timer()
+            cold = run_cli(['--cold'], text)
+            times['cold_cli'].append(timer() - start)
+            start = timer()
+            warm = client.score(text, language)
+            times['warm_client'].append(timer() - start)
+            start = timer()
+            client.score(text, language)
+            times['cached_client'].append(timer() - start)
+            start = timer()
+            run_cli(['--socket', socket_path], text)
+            times['warm_cli'].append(timer() - start)
+            if cold != warm:
+                raise Exception("The daemon gives different results")
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(temp_dir)
+    res = {'corpus': lyrics_dir, 'language': language, 'verses': len(texts)}
+    for mode, mode_times in times.items():
+        res[mode] = float(np.median(mode_times))
+    print 'Scoring latency (median ms): %s' % ', '.join(
+            '%s %.1f' % (mode, 1000*res[mode]) for mode in
+            ['cold_cli', 'warm_cli', 'warm_client', 'cached_client'])
+    return res
+
+def run_word_dict_benchmarks(lyrics_dir='lyrics_en', language='en-us',
+                             lookback=15, espeak_procs=1):
+    '''
+    Time raplyzer.compare_word_transcriptions with an empty word dictionary
+    (the words are sent to eSpeak) and again with the filled dictionary, and
+    report its hit rates and transcription differences.
+    '''
+    temp_dir = tempfile.mkdtemp(prefix='raplyzer_bench_')
+    word_phonemes = os.path.join(temp_dir, 'words.sqlite')
+    res = {'corpus': lyrics_dir, 'language': language}
+    try:
+        for run in ['cold', 'warm']:
+            start = timer()
+            report = raplyzer.compare_word_transcriptions(
+                    word_phonemes, lyrics_dir, language, lookback,
+                    espeak_procs)
+            report['seconds'] = timer() - start
+            res[run] = report
+    finally:
+        shutil.rmtree(temp_dir)
+    for run in ['cold', 'warm']:
+        report = res[run]
+        print ('Word dictionary (%s): %.1f ms, hit rate %.3f, %d words '
+               'transcribed, songs differing %.3f, words differing %.3f, '
+               'rhyme length diff %.3f') % (
+                run, 1000*report['seconds'], report['token_hit_rate'],
+                report['types_transcribed'], report['songs_differing'],
+                report['words_differing'], report['mean_rhyme_length_diff'])
+    return res
+
+def result_key(res):
+    return (res['corpus'], res['language'], res['lines'], res['lookback'],
+            res['engine'])
+
+def print_result(res):
+    print '%-10s %-6s lines=%-5s lookback=%-3d %-6s %8.1f ms  (%s)' % (
+            res['corpus'], res['language'], res['lines'], res['lookback'],
+            res['engine'], 1000*res['seconds']['total'],
+            ', '.join('%s %.1f' % (s, 1000*res['seconds'][s])
+                      for s in STAGES))
+
+def compare(fname1, fname2):
+    '''
+    Print the ratio of the stage times in two result files (new / old).
+    '''
+    old = json.load(open(fname1))
+    new = json.load(open(fname2))
+    old_results = dict((result_key(r), r) for r in old['results'])
+    print '%s -> %s' % (old['meta'].get('commit'), new['meta'].get('commit'))
+    for res in new['results']:
+        key = result_key(res)
+        if key not in old_results:
+            continue
+        ratios = []
+        for s in STAGES + ['total']:
+            t_old = old_results[key]['seconds'][s]
+            if t_old > 0:
+                ratios.append('%s %.2fx' % (s, res['seconds'][s] / t_old))
+        print '%-10s %-6s lines=%-5s lookback=%-3d %-6s %s' % (
+                key + (', '.join(ratios),))
+    if old.get('word_dict') is not None and new.get('word_dict') is not None:
+        print 'word dictionary %s' % ', '.join(
+                '%s %.2fx' % (run, new['word_dict'][run]['seconds'] /
+                              old['word_dict'][run]['seconds'])
+                for run in ['cold', 'warm'])
+
+def get_meta():
+    commit = None
+    try:
+        commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {'commit': commit, 'date': dt.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='Write the results to a JSON '
+                        'file.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[20, 80, 320],
+                        help='Lengths of the synthetic songs (in lines).')
+    parser.add_argument('--lookbacks', type=int, nargs='+',
+                        default=[5, 10, 15, 30])
+    parser.add_argument('--engines', nargs='+', default=['loop', 'numpy'])
+    parser.add_argument('--songs', type=int, default=10,
+                        help='Number of synthetic songs of each length.')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--rhyme-density', type=float, default=0.5)
+    parser.add_argument('--repetition', type=float, default=0.1)
+    parser.add_argument('--no-corpora', action='store_true',
+                        help="Don't benchmark the bundled corpora.")
+    parser.add_argument('--server', action='store_true',
+                        help='Benchmark the latency of the scoring daemon '
+                        '(scoring_server.py) against the cold path.')
+    parser.add_argument('--word-dict', action='store_true',
+                        help='Benchmark the word-by-word transcription of '
+                        'the English corpus (needs eSpeak).')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two result files.')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+    results = run_benchmarks(args.lines, args.lookbacks, args.engines,
+                             args.songs, args.repeats, args.rhyme_density,
+                             args.repetition, not args.no_corpora)
+    memory = []
+    if not args.no_corpora:
+        memory = run_memory_benchmarks()
+    server = None
+    if args.server:
+        server = run_server_benchmarks()
+    word_dict = None
+    if args.word_dict:
+        word_dict = run_word_dict_benchmarks()
+    if args.output is not None:
+        f = open(args.output, 'w')
+        json.dump({'meta': get_meta(), 'results': results, 'memory': memory,
+                   'server': server, 'word_dict': word_dict}, f, indent=1)
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import codecs
+import threading
+import Queue
+from timeit import default_timer as timer
+
+'''
+This file contains the I/O of reading a corpus of lyrics: listing the
+directories and reading the song files (and their transcriptions) ahead of
+the analysis in a few threads, so that the analysis doesn't wait for the
+reads on slow (e.g. network) file systems.
+
+Usage:
+    for file_name, text, transcription, seconds in read_songs(file_names,
+                                                             'en-us'):
+        l = Lyrics(file_name, text=text, transcription=transcription, ...)
+'''
+
+# os.scandir (Python 3.5+) or the scandir package tell whether an entry is a
+# directory without an extra stat call. Otherwise use os.listdir.
+try:
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+def list_dir(path):
+    '''
+    List a directory.
+
+    Output:
+        List of (name, is_dir) tuples in the order of os.listdir.
+    '''
+    if _scandir is not None:
+        return [(entry.name, entry.is_dir()) for entry in _scandir(path)]
+    return [(name, os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+def read_song(file_name, read_transcription=True):
+    '''
+    Read a song file and, if read_transcription is True, its stored
+    transcription (<song>.txt.ipa).
+
+    Output:
+        Tuple (file name, text, transcription, seconds spent reading). The
+        transcription is None if it wasn't read or it doesn't exist.
+    '''
+    start = timer()
+    f = codecs.open(file_name, 'r', 'utf8')
+    text = f.read()
+    f.close()
+    transcription = None
+    if read_transcription and os.path.exists(file_name + '.ipa'):
+        f = codecs.open(file_name + '.ipa', 'r', 'utf8')
+        transcription = f.read()
+        f.close()
+    return file_name, text, transcription, timer() - start
+
+def read_songs(file_names, language, read_transcriptions=True, n_threads=4,
+               read_ahead=16):
+    '''
+    Read the songs (see read_song) in the background and yield them in the
+    order of file_names. The transcriptions are read only for English and
+    if read_transcriptions is True (i.e. they are not taken from a
+    transcription cache).
+    '''
+    english = len(language) >= 2 and language[:2] == 'en'
+    read_transcriptions = read_transcriptions and english
+    return prefetch(file_names,
+                    lambda file_name: read_song(file_name,
+                                                read_transcriptions),
+                    n_threads, read_ahead)
+
+class _Slot:
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+def prefetch(items, read, n_threads=4, read_ahead=16):
+    '''
+    Apply read to the items in n_threads threads and yield the results in
+    the order of the items. At most read_ahead items are read ahead of the
+    consumer, so the memory usage doesn't depend on the number of items.
+    An exception raised by read is raised when its result would be yielded.
+    '''
+    # Slots in the order of the items. The bounded queue stops the producer
+    # when the consumer is read_ahead items behind.
+    pending = Queue.Queue(read_ahead)
+    work = Queue.Queue()
+    stopped = threading.Event()
+
+    def put_pending(slot):
+        # Give up if the consumer has stopped
+        while not stopped.is_set():
+            try:
+                pending.put(slot, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                slot = _Slot(item)
+                if not put_pending(slot):
+                    break
+                work.put(slot)
+        finally:
+            put_pending(None)
+            for i in range(n_threads):
+                work.put(None)
+
+    def run_reads():
+        while True:
+            slot = work.get()
+            if slot is None:
+                return
+            try:
+                slot.result = read(slot.item)
+            except Exception:
+                slot.error = sys.exc_info()
+            slot.done.set()
+
+    threads = [threading.Thread(target=produce)]
+    threads += [threading.Thread(target=run_reads) for i in range(n_threads)]
+    for thread in threads:
+        # Don't keep the process alive if the consumer stops early
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            slot = pending.get()
+            if slot is None:
+                return
+            slot.done.wait()
+            if slot.error is not None:
+                raise slot.error[0], slot.error[1], slot.error[2]
+            yield slot.result
+    finally:
+        # Let the threads finish if the consumer stopped early
+        stopped.set()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import json
+import struct
+import hashlib
+import numpy as np
+
+from lyrics import Lyrics
+
+'''
+This file contains functions for storing the preprocessed lyrics of a whole
+corpus to a single binary pack file. The pack is read with np.memmap, so
+songs can be analyzed without reading, cleaning or transcribing the lyrics
+again, and the pack can be shared read-only by several processes.
+
+File format:
+    8 bytes         Magic string 'RAPPACK1'.
+    8 bytes         Length of the header (little-endian unsigned integer).
+    header          JSON header with the language, the artist, album and
+                    file name of each song and the dtype, offset and shape
+                    of each array.
+    arrays          Arrays aligned to 8 bytes. The per-vowel, per-word and
+                    per-line arrays of all songs are concatenated and the
+                    'songs' array has the offsets of each song.
+'''
+
+MAGIC = 'RAPPACK1'
+
+# Columns of the 'songs' array: the offset of the first element of each
+# song in the concatenated arrays and the number of elements
+SONG_COLUMNS = ['vow_start', 'n_vow', 'word_start', 'n_words', 'line_start',
+                'n_lines', 'text_start', 'text_len', 'orig_start', 'orig_len']
+
+# Per-vowel arrays (int32)
+VOWEL_ARRAYS = ['vow', 'vow_idxs', 'vow_word_start', 'vow_word_end',
+                'vow_word_id']
+
+def write_pack(pack_path, song_lists, language, **lyrics_args):
+    '''
+    Preprocess the songs and write them to a pack file.
+
+    Input:
+        pack_path   Path of the pack file.
+        song_lists  Songs to be stored (see raplyzer.list_songs).
+        language    Language of the lyrics.
+        lyrics_args Other arguments for Lyrics (e.g. the transcription
+                    cache).
+    '''
+    arrays = dict((name, []) for name in VOWEL_ARRAYS +
+                  ['word_ends', 'word_ids', 'line_starts'])
+    texts = []
+    origs = []
+    songs = []
+    song_rows = []
+    counts = dict((c, 0) for c in SONG_COLUMNS)
+    for a, albums in song_lists:
+        for al, file_names in albums:
+            for file_name in file_names:
+                l = Lyrics(file_name, language=language, **lyrics_args)
+                song = song_arrays(l)
+                for name in arrays:
+                    arrays[name].append(song[name])
+                text = l.text.encode('utf8')
+                orig = ''
+                if language != 'fi':
+                    orig = l.text_orig.encode('utf8')
+                texts.append(text)
+                origs.append(orig)
+                row = [counts['vow_start'], len(song['vow']),
+                       counts['word_start'], len(song['word_ends']),
+                       counts['line_start'], len(song['line_starts']),
+                       counts['text_start'], len(text),
+                       counts['orig_start'], len(orig)]
+                counts['vow_start'] += len(song['vow'])
+                counts['word_start'] += len(song['word_ends'])
+                counts['line_start'] += len(song['line_starts'])
+                counts['text_start'] += len(text)
+                counts['orig_start'] += len(orig)
+                song_rows.append(row)
+                songs.append({'artist': a, 'album': al,
+                              'filename': file_name})
+
+    data = {}
+    for name in arrays:
+        data[name] = np.concatenate(
+                [np.zeros(0, np.int32)] + arrays[name]).astype(np.int32)
+    data['text'] = np.array(bytearray(''.join(texts)), dtype=np.uint8)
+    data['orig'] = np.array(bytearray(''.join(origs)), dtype=np.uint8)
+    data['songs'] = np.array(song_rows, dtype=np.int64).reshape(
+            len(song_rows), len(SONG_COLUMNS))
+
+    header = {'language': language, 'songs': songs, 'arrays': {}}
+    # The offsets of the arrays depend on the length of the header, so
+    # increase the reserved header length until the header fits
+    header_len = 0
+    while True:
+        offset = 16 + header_len
+        for name in sorted(data):
+            header['arrays'][name] = {'dtype': data[name].dtype.str,
+                                      'shape': data[name].shape,
+                                      'offset': offset}
+            offset += _align(data[name].nbytes)
+        header_str = json.dumps(header)
+        if len(header_str) <= header_len:
+            break
+        header_len = _align(len(header_str))
+    header_str += ' ' * (header_len - len(header_str))
+
+    f = open(pack_path, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', header_len))
+    f.write(header_str)
+    for name in sorted(data):
+        buf = data[name].tostring()
+        f.write(buf)
+        f.write('\0' * (_align(len(buf)) - len(buf)))
+    f.close()
+    return len(songs)
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+def song_arrays(l):
+    '''
+    Integer arrays representing the vowels, words and lines of Lyrics l.
+    Words are represented by IDs which are unique within the song.
+    '''
+    song = {}
+    song['vow'] = np.array([ord(c) for c in l.vow], dtype=np.int32)
+    for name in VOWEL_ARRAYS[1:]:
+        song[name] = np.array(getattr(l, name), dtype=np.int32)
+    song['word_ends'] = np.array(l.word_ends, dtype=np.int32)
+    word_ids = {}
+    song['word_ids'] = np.array([word_ids.setdefault(w, len(word_ids))
+                                 for w in l.words], dtype=np.int32)
+    song['line_starts'] = np.array(l.line_starts, dtype=np.int32)
+    return song
+
+class CorpusPack:
+    '''
+    Read-only view to a pack file written by write_pack. The arrays are
+    memory-mapped, so only the pages of the analyzed songs are read.
+    '''
+
+    def __init__(self, pack_path):
+        self.path = pack_path
+        f = open(pack_path, 'rb')
+        if f.read(8) != MAGIC:
+            f.close()
+            raise Exception("Not a lyrics pack file: %s" % pack_path)
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        f.close()
+        self.language = header['language']
+        self.songs = header['songs']
+        self.index = dict((s['filename'], i) for i, s in enumerate(self.songs))
+        self.arrays = {}
+        for name, a in header['arrays'].items():
+            shape = tuple(a['shape'])
+            if np.prod(shape) == 0:
+                self.arrays[name] = np.zeros(shape, dtype=a['dtype'])
+            else:
+                self.arrays[name] = np.memmap(pack_path, dtype=a['dtype'],
+                                              mode='r', offset=a['offset'],
+                                              shape=shape)
+        self.table = self.arrays['songs']
+
+    def __len__(self):
+        return len(self.songs)
+
+    def list_songs(self, artist=None, album=None):
+        '''
+        List the songs in the same format as raplyzer.list_songs.
+        '''
+        song_lists = []
+        for s in self.songs:
+            if artist is not None and s['artist'] != artist:
+                continue
+            if album is not None and s['album'] != album:
+                continue
+            if len(song_lists) == 0 or song_lists[-1][0] != s['artist']:
+                song_lists.append((s['artist'], []))
+            albums = song_lists[-1][1]
+            if len(albums) == 0 or albums[-1][0] != s['album']:
+                albums.append((s['album'], []))
+            albums[-1][1].append(s['filename'])
+        return song_lists
+
+    def _slice(self, name, i, column):
+        start = self.table[i, SONG_COLUMNS.index(column)]
+        n = self.table[i, SONG_COLUMNS.index(column)+1]
+        return self.arrays[name][start:start+n]
+
+    def content_hash(self, i):
+        '''
+        Hash of the preprocessed text (and for English the original text) of
+        song i (or of the song with the given file name). The other arrays
+        of the song are computed from them.
+        '''
+        if not isinstance(i, (int, long, np.integer)):
+            i = self.index[i]
+        h = hashlib.sha1()
+        h.update(self._slice('text', i, 'text_start').tostring())
+        h.update('\0')
+        if self.language != 'fi':
+            h.update(self._slice('orig', i, 'orig_start').tostring())
+        return h.hexdigest()
+
+    def get_lyrics(self, i, lookback=None, engine='numpy'):
+        '''
+        Construct a Lyrics object of song i (or of the song with the given
+        file name) without re-processing the lyrics. The vowels are
+        represented by their integer codes and the words by integer IDs.
+        '''
+        if not isinstance(i, (int, long, np.integer)):
+            i = self.index[i]
+        if lookback is None:
+            lookback = 10 if self.language == 'fi' else 15
+        l = Lyrics(language=self.language, lookback=lookback, engine=engine)
+        l.filename = self.songs[i]['filename']
+        l.text = self._slice('text', i, 'text_start').tostring().decode('utf8')
+        for name in VOWEL_ARRAYS:
+            setattr(l, name, self._slice(name, i, 'vow_start'))
+        l.word_ends = self._slice('word_ends', i, 'word_start')
+        l.words = self._slice('word_ids', i, 'word_start')
+        l.line_starts = self._slice('line_starts', i, 'line_start')
+        if self.language != 'fi':
+            l.text_orig = self._slice('orig', i, 'orig_start').tostring(
+                    ).decode('utf8')
+            l.lines_orig = l.text_orig.split('\n')
+        # The rhyme stats are computed when they are used
+        return l
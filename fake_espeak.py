@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+A stand-in for eSpeak which can be used for testing the transcription
+backends (phonetics.EspeakProcess, phonetics.EspeakPool) on machines
+without eSpeak:
+
+    pool = phonetics.EspeakPool(command=[sys.executable, 'fake_espeak.py'])
+
+Like "espeak -xq", it reads text line by line from stdin (or from the
+file given with -f) and writes a pseudo-phonetic transcription of each
+line to stdout. The transcription only keeps the letters and maps the
+vowels to eSpeak vowel symbols, so it is deterministic but not realistic.
+'''
+
+import sys
+import codecs
+
+VOWEL_MAP = {
+        u'a': u'a',
+        u'e': u'E',
+        u'i': u'I',
+        u'o': u'0',
+        u'u': u'V',
+        u'y': u'i',
+        }
+
+def transcribe_line(line):
+    words = []
+    for w in line.lower().split():
+        w = u''.join(VOWEL_MAP.get(c, c) for c in w if c.isalpha())
+        if len(w) > 0:
+            words.append(w)
+    return u' ' + u' '.join(words)
+
+def main():
+    fname = None
+    args = sys.argv[1:]
+    if '-f' in args:
+        fname = args[args.index('-f')+1]
+    if fname is not None:
+        f = codecs.open(fname, 'r', 'utf8')
+        for line in f:
+            sys.stdout.write((transcribe_line(line) + u'\n').encode('utf8'))
+        f.close()
+        return
+    while True:
+        line = sys.stdin.readline()
+        if len(line) == 0:
+            break
+        line = line.decode('utf8')
+        if len(line.strip()) == 0:
+            continue
+        sys.stdout.write((transcribe_line(line) + u'\n').encode('utf8'))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
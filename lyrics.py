@@ -4,143 +4,510 @@ import codecs
 import re
 import numpy as np
 import os
+import sys
+import bisect
+from array import array
 
 import phonetics as ph
+import profiling
+
+# Characters replaced by spaces in the preprocessing. For English we need to
+# keep apostrophes since they affect the pronunciation.
+SUBSTITUTE_RES = {
+        'fi': re.compile(u'[^\wåäö\n]+'),
+        'en': re.compile(u"[^\wåÅäÄöÖéÉ'’\.\?!\n]+"),
+        }
+NEWLINES_RE = re.compile('\n\n+')
+NON_WORD_RE = re.compile(u'[^\wåäö]+')
+
+# Attributes set by the stages of the analysis (see Lyrics.__getattr__).
+# text is set by the cleaning (Finnish) or by the transcription (English).
+CLEAN_ATTRS = frozenset(['lines', '_uniq_lines'])
+VOWEL_ATTRS = frozenset(['vow', 'vow_idxs', 'word_ends', 'words',
+                         'line_starts', 'vow_word_start', 'vow_word_end',
+                         'vow_word_id', '_word_ids', '_prev_space_idx'])
+VOWEL_ATTRS_EN = frozenset(['word_ends_orig', 'words_orig'])
+STATS_ATTRS = frozenset(['avg_rhyme_length', 'longest_rhyme'])
+LAZY_ATTRS = CLEAN_ATTRS | VOWEL_ATTRS | VOWEL_ATTRS_EN | STATS_ATTRS | \
+        frozenset(['text', 'text_orig', 'lines_orig'])
+# Texts which append_line extends (see Lyrics._append_text)
+APPENDED_ATTRS = frozenset(['text_raw', 'text', 'text_orig'])
+
+def _scan_tables(lang):
+    '''
+    Lookup tables (indexed by character code) telling whether a character
+    is a vowel after ph.map_vow and what it's mapped to.
+    '''
+    vowels = ph.VOWELS[lang]
+    vow_map = ph.VOWEL_MAPS[lang]
+    is_vow = np.zeros(0x10000, dtype=bool)
+    mapped = np.arange(0x10000)
+    for c in vowels:
+        is_vow[ord(c)] = True
+    for c, v in vow_map.items():
+        mapped[ord(c)] = ord(v)
+        is_vow[ord(c)] = v in vowels
+    return is_vow, mapped
+
+SCAN_TABLES = dict((lang, _scan_tables(lang)) for lang in ph.VOWELS)
+
+def _char_codes(text):
+    '''
+    Character codes of text as an array with the same indexing as text.
+    '''
+    text = unicode(text)
+    if sys.maxunicode > 0xffff:
+        return np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+    else:
+        return np.frombuffer(text.encode('utf-16-le'), dtype='<u2')
 
-class Lyrics:
+class Lyrics(object):
     '''
     This class is used to store and preprocess rap lyrics and calculate
     statistics like average rhyme length out of the lyrics.
     '''
 
+    # Lyrics objects are created for every song of a corpus, so attributes
+    # are stored in slots instead of a dict per object
+    __slots__ = ('filename', 'ipa_fname', 'language', 'lookback', 'engine',
+                 'backend', 'cache', 'word_dict', 'lean', 'text_raw', 'text',
+                 'text_orig', 'lines', 'lines_orig', 'vow', 'vow_idxs',
+                 'word_ends', 'words', 'line_starts', 'vow_word_start',
+                 'vow_word_end', 'vow_word_id', 'word_ends_orig',
+                 'words_orig', 'avg_rhyme_length', 'longest_rhyme',
+                 '_word_ids', '_uniq_lines', '_prev_space_idx',
+                 '_n_raw_lines', '_n_empty_lines', '_rl_sum',
+                 '_longest_rhyme_str', '_ipa_text', '_appended')
+
     def __init__(self, filename=None, print_stats=False, text=None, 
-                 language='fi', lookback=10):
+                 language='fi', lookback=10, engine='loop', backend=None,
+                 cache=None, word_dict=None, lean=False,
+                 transcription=None):
         '''
         Lyrics can be read from the file (default) or passed directly
-        to this constructor.
+        to this constructor. If both filename and text are given, text is
+        the content of the file which has been read already (see
+        corpus_loader.read_songs), and transcription can be the content of
+        the <filename>.ipa file.
+
+        The rhyme statistics are computed either word by word in Python
+        (engine='loop') or for all word pairs at once with NumPy
+        (engine='numpy'). Both engines give exactly the same results.
+
+        English lyrics without a stored transcription are transcribed with
+        the given eSpeak backend (see phonetics.EspeakPool) or, by default,
+        by starting a new eSpeak process. If a transcription cache (see
+        phonetics.TranscriptionCache) is given, it's used instead of the
+        <filename>.ipa files. If a word dictionary (see
+        phonetics.WordPhonemeDict) is given, the lyrics are transcribed word
+        by word using it.
+
+        The stages of the analysis (cleaning, transcription, vowel
+        representation and rhyme stats) are run lazily when their results
+        are accessed for the first time (see __getattr__), so e.g. getting
+        the words of the lyrics doesn't compute the rhyme stats. If
+        print_stats or lean is True, all stages are run right away.
+
+        If lean is True, the memory usage is reduced after the analysis (see
+        compact).
         '''
+        # Raises an exception for an unknown language
+        ph.language_key(language)
         self.text_raw = None
+        self._appended = None
+        self.lean = lean
         # How many previous words are checked for a rhyme.
         self.lookback = lookback
+        if engine not in ('loop', 'numpy'):
+            raise Exception("Unknown rhyme engine: %s" % engine)
+        self.engine = engine
+        self.backend = backend
+        self.cache = cache
+        self.word_dict = word_dict
+        # The transcription of lyrics read from a file is stored next to the
+        # file. Lyrics passed directly are never stored (they would overwrite
+        # each other's transcriptions).
+        self.ipa_fname = None
+        self._ipa_text = None
         if filename is not None:
             self.filename = filename
-            f = codecs.open(filename, 'r', 'utf8')
-            self.text_raw = f.read()
-            f.close()
+            self.ipa_fname = filename + '.ipa'
+            if text is not None:
+                self.text_raw = text
+                self._ipa_text = transcription
+            else:
+                with profiling.stage('read'):
+                    f = codecs.open(filename, 'r', 'utf8')
+                    self.text_raw = f.read()
+                    f.close()
         elif text is not None:
             self.text_raw = text
             self.filename = 'No filename'
         self.language = language
 
+        # Line counters used by append_line
+        self._n_raw_lines = 0
+        self._n_empty_lines = 0
         if self.text_raw is not None:
-            cleaning_ok = self.clean_text(self.text_raw)
-            self.compute_vowel_representation()
-            self.avg_rhyme_length, self.longest_rhyme = self.rhyme_stats()
-
+            self._n_raw_lines = self.text_raw.count('\n') + 1
+            if print_stats or lean:
+                self.analyze()
             if print_stats:
                 #self.print_song_stats_compact()
                 self.print_song_stats()
+            if lean:
+                self.compact()
+
+    def __getattr__(self, name):
+        '''
+        Called only for attributes which haven't been set. If the attribute
+        is a result of a stage of the analysis, the stage is run (which
+        sets the attribute) instead of raising AttributeError. Texts
+        extended by append_line are joined here.
+        '''
+        if name in APPENDED_ATTRS and self._appended is not None and \
+                name in self._appended:
+            parts, length = self._appended.pop(name)
+            setattr(self, name, u''.join(parts))
+            return object.__getattribute__(self, name)
+        if name not in LAZY_ATTRS:
+            raise AttributeError(name)
+        english = len(self.language) >= 2 and self.language[:2] == 'en'
+        if name in CLEAN_ATTRS or (name == 'text' and not english) or \
+                (name == 'text_orig' and english):
+            self._run_cleaning()
+        elif english and name in ('text', 'lines_orig'):
+            self._run_transcription()
+        elif name in VOWEL_ATTRS or (english and name in VOWEL_ATTRS_EN):
+            self.compute_vowel_representation()
+        elif name in STATS_ATTRS:
+            # Run the earlier stages first so that they are timed separately
+            self.vow
+            with profiling.stage('rhyme_stats'):
+                self.avg_rhyme_length, self.longest_rhyme = self.rhyme_stats()
+        else:
+            raise AttributeError(name)
+        return object.__getattribute__(self, name)
+
+    def analyze(self):
+        '''
+        Run all stages of the analysis which haven't been run yet.
+
+        Output:
+            Average rhyme length and the longest rhyme (see rhyme_stats).
+        '''
+        return self.avg_rhyme_length, self.longest_rhyme
+
+    def _run_cleaning(self):
+        if self.text_raw is None:
+            raise AttributeError("No lyrics to be analyzed")
+        with profiling.stage('clean_text'):
+            self.clean_text(self.text_raw)
+        if len(self.language) >= 2 and self.language[:2] == 'en':
+            # self.text will be the transcription of the cleaned text
+            self.text_orig = self.text
+            del self.text
+
+    def _run_transcription(self):
+        text_orig = self.text_orig
+        with profiling.stage('transcription'):
+            self.text = self._transcribe(text_orig, self.ipa_fname,
+                                         self._ipa_text)
+        self._ipa_text = None
+        self.lines_orig = text_orig.split('\n')
 
     def clean_text(self, text):
         '''
         Preprocess text by removing unwanted characters and duplicate rows.
         '''
-        if self.language == 'fi':
-            self.text = text.lower()
-            # Replace all but word characters and newlines by spaces
-            rx = re.compile(u'[^\wåäö\n]+')
-        else: # English
-            self.text = text
-            # For English we need to keep apostrophes since they affect the 
-            # pronunciation
-            rx = re.compile(u"[^\wåÅäÄöÖéÉ'’\.\?!\n]+")
-
-        self.text = rx.sub(' ', self.text)
+        self.text = self._substitute(text)
         # If there are more than 2 consecutive newlines, remove some of them
         # (just to make the cleaned text look prettier)
-        self.text = re.sub('\n\n+', '\n\n', self.text)
+        self.text = NEWLINES_RE.sub('\n\n', self.text)
         # Remove duplicate rows
         self.lines = self.text.split('\n')
 
-        uniq_lines = set()
-        new_text = ''
-        for l in self.lines:
-            l = l.strip()
-            if len(l) > 0 and l in uniq_lines:
-                continue
-            # Remove lines that are within brackets/parenthesis
-            if len(l) >= 2 and ((l[0]=='[' and l[-1]==']') or (l[0]=='(' and l[-1]==')')):
-                continue
-            uniq_lines.add(l)
-            if self.language == 'fi':
-                new_text += l + '\n'
-            else: # English
-                # Add '.' to the end of line since otherwise the lines might be
-                # too long so that espeak won't transcribe the whole line
-                new_text += l + '.\n'
+        self._uniq_lines = set()
+        self.text = ''.join([self._clean_line(l) for l in self.lines])
 
-        self.text = new_text
+    def _substitute(self, text):
+        if self.language == 'fi':
+            text = text.lower()
+            # Replace all but word characters and newlines by spaces
+            return SUBSTITUTE_RES['fi'].sub(' ', text)
+        else: # English
+            return SUBSTITUTE_RES['en'].sub(' ', text)
+
+    def _clean_line(self, l):
+        '''
+        Return the cleaned line (with a line break) or an empty string if
+        the line is removed.
+        '''
+        l = l.strip()
+        if len(l) > 0 and l in self._uniq_lines:
+            return ''
+        # Remove lines that are within brackets/parenthesis
+        if len(l) >= 2 and ((l[0]=='[' and l[-1]==']') or (l[0]=='(' and l[-1]==')')):
+            return ''
+        self._uniq_lines.add(l)
+        if self.language == 'fi':
+            return l + '\n'
+        else: # English
+            # Add '.' to the end of line since otherwise the lines might be
+            # too long so that espeak won't transcribe the whole line
+            return l + '.\n'
 
     def compute_vowel_representation(self):
         '''
         Compute a representation of the lyrics where only vowels are preserved.
+        For English, the vowels are read from the phonetic transcription.
         '''
+        # Clean and transcribe the text first if needed
+        self.text
+        self._init_vowel_representation()
+        with profiling.stage('vowel_representation'):
+            self._scan_vowels(0)
+
+    def _init_vowel_representation(self):
         self.vow = [] # Lyrics with all but vowels removed
         self.vow_idxs = [] # Indices of the vowels in self.text list
         self.word_ends = [] # Indices of the last characters of each word
         self.words = [] # List of words in the lyrics
-        self.line_idxs = []
-
+        self.line_starts = [0] # Indices of the first characters of each line
+        # For each vowel, the indices of the first and the last character of
+        # the surrounding word in self.text and an ID of the word (identical
+        # words share the ID)
+        self.vow_word_start = []
+        self.vow_word_end = []
+        self.vow_word_id = []
+        self._word_ids = {}
+        self._prev_space_idx = -1 # Index of the previous space char
         if len(self.language) >= 2 and self.language[:2] == 'en':
-            self.text_orig = self.text
-            self.text = ph.get_phonetic_transcription(self.text, output_fname=self.filename+'.ipa')
             self.word_ends_orig = []
             self.words_orig = []
 
-        prev_space_idx = -1 # Index of the previous space char
-        line_idx = 0 # Line index of the current character
-        # Go through the lyrics char by char
-        for i in range(len(self.text)):
-            self.line_idxs.append(line_idx)
-            c = self.text[i]
-            c = ph.map_vow(c, self.language)
-            if ph.is_vow(c, self.language):
-                # Ignore double vowels
-                # (in English this applies probably only to 'aa' as in 'bath'
-                # which rhymes with 'trap' that has only 'a')
-                if i > 0 and self.text[i-1] == c:
-                    # Index of a double vowel points to the latter occurrence
-                    self.vow_idxs[-1] = i
-                    continue
-                # TODO Diftongs should not be split (i.e. "price" should
-                # not rhyme with "trap kit"). This has been fixed in BattleBot
-                self.vow.append(c)
-                self.vow_idxs.append(i)
-            elif ph.is_space(c):
-                if c in '\n':
-                    line_idx += 1
-                elif c in '.!?' and i < len(self.text)-1 and self.text[i+1] != '\n':
-                    line_idx += 1
-                # If previous char was not a space, we've encountered word end
-                if len(self.vow) > 0 and not ph.is_space(self.text[i-1]):
-                    # Put together the new word. Potential consonants in the 
-                    # end are ignored
-                    new_word = self.text[prev_space_idx+1:self.vow_idxs[-1]+1]
-                    # Check that the new word contains at least one vowel
-                    no_vowels = True
-                    for c2 in new_word:
-                        if ph.is_vow(c2, self.language):
-                            no_vowels = False
-                            break
-                    if no_vowels:
-                        prev_space_idx = i
-                        continue
-                    self.word_ends.append(len(self.vow)-1)
-                    self.words.append(new_word)
-                prev_space_idx = i
+    def _transcribe(self, text, output_fname=None, transcription=None):
+        return ph.get_phonetic_transcription(
+                text, language=self.language, output_fname=output_fname,
+                backend=self.backend, cache=self.cache,
+                word_dict=self.word_dict, transcription=transcription)
+
+    def _scan_vowels(self, start, text=None, offset=0):
+        '''
+        Extend the vowel representation with self.text[start:].
+
+        The text is processed with array operations over the character
+        codes, so only the words are handled one by one.
+
+        If text is given, it's self.text[offset:] where offset is at most
+        the index of the first character of the word containing
+        self.text[start] (used by append_line).
+        '''
+        if text is None:
+            text = self.text
+        codes = _char_codes(text[start-offset:]).astype(int)
+        if len(codes) == 0:
+            return
+        is_vow_table, map_table = SCAN_TABLES[ph.language_key(self.language)]
+        small = np.minimum(codes, 0xffff)
+        is_vow = is_vow_table[small] & (codes <= 0xffff)
+        mapped = map_table[small]
+        is_space = (codes == ord(' ')) | (codes == ord('\n'))
+        # The previous character of each character
+        prev = np.empty_like(codes)
+        prev[1:] = codes[:-1]
+        prev[0] = ord(text[start-1-offset]) if start > 0 else -1
+
+        # Ignore double vowels
+        # (in English this applies probably only to 'aa' as in 'bath'
+        # which rhymes with 'trap' that has only 'a')
+        # TODO Diftongs should not be split (i.e. "price" should
+        # not rhyme with "trap kit"). This has been fixed in BattleBot
+        double = is_vow & (prev == mapped)
+        new_vow = np.nonzero(is_vow & ~double)[0]
+        # Index of a double vowel points to the latter occurrence. Double
+        # vowels directly follow their first vowel, so the vowels are
+        # grouped by the number of preceding (non-double) vowels.
+        all_vow = np.nonzero(is_vow)[0]
+        group = np.cumsum(~double[all_vow]) - 1
+        last_in_group = np.searchsorted(group, np.arange(len(new_vow)),
+                                        side='right') - 1
+        new_vow_idxs = all_vow[last_in_group] + start
+        n_leading = np.searchsorted(group, 0)
+        if n_leading > 0:
+            # Doubles of the last vowel of the previous text
+            self.vow_idxs[-1] = int(all_vow[n_leading-1] + start)
+
+        n_old = len(self.vow)
+        last_old = self.vow_idxs[-1] if n_old > 0 else -1
+        self.vow += list(mapped[new_vow].astype('<u4').tostring().decode(
+                'utf-32-le'))
+        self.vow_idxs += new_vow_idxs.tolist()
+
+        # Words end at spaces. Potential consonants in the end of a word are
+        # ignored and words without vowels are skipped.
+        spaces = np.nonzero(is_space)[0]
+        line_ends = spaces[codes[spaces] == ord('\n')]
+        self.line_starts += (line_ends + start + 1).tolist()
+        spaces += start
+        bounds = np.append(self._prev_space_idx, spaces)
+        n_before = np.searchsorted(new_vow, spaces - start)
+        last_vow_idx = np.append(last_old, new_vow_idxs)[n_before]
+        prev_is_space = (prev[spaces-start] == ord(' ')) | \
+                (prev[spaces-start] == ord('\n'))
+        is_word = (n_old + n_before > 0) & ~prev_is_space & \
+                (last_vow_idx > bounds[:-1])
+        self.word_ends += (n_old + n_before[is_word] - 1).tolist()
+        self.words += [text[b+1-offset:p+1-offset] for b, p in
+                       zip(bounds[:-1][is_word].tolist(),
+                           last_vow_idx[is_word].tolist())]
+
+        # Span and ID of the surrounding word of each new vowel
+        word_idx = np.searchsorted(spaces, new_vow + start)
+        word_starts = bounds + 1
+        word_ends = np.append(spaces, len(text) + offset)
+        self.vow_word_start += word_starts[word_idx].tolist()
+        self.vow_word_end += (word_ends[word_idx] - 1).tolist()
+        uniq, counts = np.unique(word_idx, return_counts=True)
+        word_ids = self._word_ids
+        ids = [word_ids.setdefault(text[b-offset:e-offset], len(word_ids))
+               for b, e in
+               zip(word_starts[uniq].tolist(), word_ends[uniq].tolist())]
+        self.vow_word_id += np.repeat(ids, counts).tolist()
+        if len(spaces) > 0:
+            self._prev_space_idx = int(spaces[-1])
+
+    def line_index(self, i):
+        '''
+        Index of the line of character self.text[i].
+        '''
+        return bisect.bisect_right(self.line_starts, i) - 1
+
+    def append_line(self, line):
+        '''
+        Add a line to the end of the lyrics and update the vowel
+        representation, self.avg_rhyme_length and self.longest_rhyme
+        incrementally, so that only the rhymes of the new words are computed.
+        This can be called also for an empty Lyrics object (no filename or
+        text given) to score lyrics line by line as they arrive.
+
+        Appending lines l1, ..., lN gives the same statistics as
+        Lyrics(text='\n'.join([l1, ..., lN])). Only the number of
+        consecutive empty lines in the cleaned text may differ (the text
+        given to the constructor is cleaned in one go, so its trailing empty
+        lines are kept). English lines are transcribed
+        separately, so the result equals a batch run only if the
+        transcription of a line doesn't depend on the other lines (e.g.
+        with a phonetics.WordPhonemeDict).
+
+        Output:
+            List of (rhyme length, wpos1) tuples for the new words (see
+            rhyme_length).
+        '''
+        if self.lean:
+            raise Exception("Lines cannot be appended to lean Lyrics")
+        if (self._appended is None or 'text_raw' not in self._appended) \
+                and self.text_raw is None:
+            self._start_lyrics()
+        else:
+            # The stages must not see the appended lines
+            self.analyze()
+        self._append_text('text_raw',
+                          '\n' + line if self._n_raw_lines > 0 else line)
+        self._n_raw_lines += 1
+
+        # Clean the line the same way as clean_text cleans the whole text
+        l = self._substitute(line)
+        self.lines.append(l)
+        if len(l) == 0:
+            # Runs of empty lines are replaced by a single empty line (two at
+            # the beginning of the text), so they are added only once the
+            # next non-empty line arrives
+            self._n_empty_lines += 1
+            return []
+        max_empty = 2 if self._n_raw_lines == self._n_empty_lines + 1 else 1
+        new_text = ''
+        for i in range(min(self._n_empty_lines, max_empty)):
+            new_text += self._clean_line('')
+        self._n_empty_lines = 0
+        new_text += self._clean_line(l)
+        if len(new_text) == 0:
+            return []
 
         if len(self.language) >= 2 and self.language[:2] == 'en':
-            self.lines_orig = self.text_orig.split('\n')
+            self._append_text('text_orig', new_text)
+            new_lines = new_text.split(u'\n')
+            self.lines_orig[-1] += new_lines[0]
+            self.lines_orig += new_lines[1:]
+            with profiling.stage('transcription'):
+                new_text = self._transcribe(new_text)
+            if len(new_text) > 0 and not ph.is_space(new_text[-1]):
+                new_text += '\n'
+        n_words = len(self.word_ends)
+        if len(new_text) > 0:
+            start = self._append_text('text', new_text)
+            # Only the new text and the previous part (which contains the
+            # beginning of the word at start) are scanned
+            prev_part = self._appended['text'][0][-2]
+            with profiling.stage('vowel_representation'):
+                self._scan_vowels(start, prev_part + new_text,
+                                  start - len(prev_part))
+
+        # Rhyme lengths of the new words
+        if not hasattr(self, '_rl_sum'):
+            self._rl_sum = 0
+            for wpos2 in range(1, n_words):
+                self._rl_sum += self.rhyme_length(wpos2)[0]
+        new_rls = []
+        for wpos2 in range(max(n_words, 1), len(self.word_ends)):
+            (rl, wpos1) = self.rhyme_length(wpos2)
+            new_rls.append((rl, wpos1))
+            self._rl_sum += rl
+            if rl > self.longest_rhyme[0]:
+                self.longest_rhyme = (rl, wpos1, wpos2)
+        if len(self.word_ends) > 1:
+            self.avg_rhyme_length = \
+                    np.float64(self._rl_sum) / (len(self.word_ends)-1)
+        return new_rls
+
+    def _append_text(self, name, text):
+        '''
+        Append text to a text attribute (see APPENDED_ATTRS). Appending to a
+        long string copies it, so the parts are joined only when the
+        attribute is read.
+
+        Output:
+            Length of the attribute before appending.
+        '''
+        if self._appended is None:
+            self._appended = {}
+        if name not in self._appended:
+            old = getattr(self, name)
+            delattr(self, name)
+            self._appended[name] = [[old], len(old)]
+        appended = self._appended[name]
+        start = appended[1]
+        appended[0].append(text)
+        appended[1] += len(text)
+        return start
+
+    def _start_lyrics(self):
+        '''
+        Initialize empty lyrics for append_line.
+        '''
+        self.text_raw = ''
+        self.filename = 'No filename'
+        self.ipa_fname = None
+        self.text = ''
+        self.lines = []
+        self._uniq_lines = set()
+        self._init_vowel_representation()
+        if len(self.language) >= 2 and self.language[:2] == 'en':
+            self.text_orig = ''
+            self.lines_orig = ['']
+        self._rl_sum = 0
+        self.avg_rhyme_length = 0
+        self.longest_rhyme = (0,None,None)
 
     def rhyme_length(self, wpos2):
         '''
@@ -173,6 +540,8 @@ class Lyrics:
         if wpos1 < 0: # Don't wrap
             return 0
         elif self.words[wpos1] == self.words[wpos2]:
+            if profiling.active is not None:
+                profiling.count('rhyme_length_fixed')
             return 0
         # Indices in the vowel list
         p1 = self.word_ends[wpos1]
@@ -181,30 +550,39 @@ class Lyrics:
         while self.vow[p1-l] == self.vow[p2-l]:
             # Make sure that exactly same words are not used
             if wpos1 > 0 and p1-l <= self.word_ends[wpos1-1] and wpos2 > 0 and p2-l <= self.word_ends[wpos2-1]:
-                # Get the first and last character indices of the words surrounding the vowels at p1-l and p2-l
-                prev_s1 = self.vow_idxs[p1-l]
-                while prev_s1 > 0 and not ph.is_space(self.text[prev_s1-1]):
-                    prev_s1 -= 1
-                prev_s2 = self.vow_idxs[p2-l]
-                while prev_s2 > 0 and not ph.is_space(self.text[prev_s2-1]):
-                    prev_s2 -= 1
-                next_s1 = self.vow_idxs[p1-l]
-                while next_s1 < len(self.text)-1 and not ph.is_space(self.text[next_s1+1]):
-                    next_s1 += 1
-                next_s2 = self.vow_idxs[p2-l]
-                while next_s2 < len(self.text)-1 and not ph.is_space(self.text[next_s2+1]):
-                    next_s2 += 1
-                if next_s1-prev_s1 == next_s2-prev_s2 and self.text[prev_s1:next_s1+1] ==  self.text[prev_s2:next_s2+1]:
+                if self.vow_word_id[p1-l] == self.vow_word_id[p2-l]:
                     break
 
             l += 1
             if p1-l < 0 or p2-l <= p1:
                 break
+        if profiling.active is not None:
+            self._count_rhyme_work(wpos1, wpos2, l)
         # Ignore rhymes with length 1
         if l == 1:
             l = 0
         return l
 
+    def _count_rhyme_work(self, wpos1, wpos2, l):
+        '''
+        Add the vowel comparisons and word boundary checks done by
+        rhyme_length_fixed to the profiling counters. They are derived from
+        the result so that the loop itself is not slowed down.
+        '''
+        p1 = self.word_ends[wpos1]
+        p2 = self.word_ends[wpos2]
+        capped = p1-l < 0 or p2-l <= p1
+        profiling.count('rhyme_length_fixed')
+        profiling.count('vowel_comparisons', l if capped else l+1)
+        if wpos1 > 0 and wpos2 > 0:
+            # The last step at which the loop body was executed
+            last = l-1
+            if not capped and self.vow[p1-l] == self.vow[p2-l]:
+                last = l
+            first = max(p1 - self.word_ends[wpos1-1],
+                        p2 - self.word_ends[wpos2-1])
+            profiling.count('word_boundary_checks', max(0, last-first+1))
+
     def rhyme_stats(self):
         '''
         Compute the average rhyme length of the song and the longest rhyme.
@@ -215,6 +593,8 @@ class Lyrics:
                 (length, word index of the first part of the rhyme,
                          word index of the latter part of the rhyme)
         '''
+        if self.engine == 'numpy':
+            return self.rhyme_stats_numpy()
         # Rhyme length of each word
         rls = []
         # Keep track of the longest rhyme
@@ -232,18 +612,222 @@ class Lyrics:
             avg_rl = 0
         return avg_rl, max_rhyme
 
+    def rhyme_length_matrix(self, lookback=None):
+        '''
+        Compute rhyme_length_fixed(wpos2-d, wpos2) for every word wpos2 and
+        every offset d = 1..lookback (default: self.lookback) at once.
+
+        For a fixed vowel distance D, the rhyme starting from vowel pair
+        (i, i+D) can be read from the diagonal vow[i] == vow[i+D], so we
+        compute run lengths of equal vowels (and the positions of equal
+        words) along each diagonal and then pick the values for all word
+        pairs from these arrays.
+
+        Output:
+            Integer array of shape (lookback, number of words) where
+            element [d-1, wpos2] is the rhyme length between words wpos2-d
+            and wpos2 (0 if wpos2-d < 0).
+        '''
+        if lookback is None:
+            lookback = self.lookback
+        n_words = len(self.word_ends)
+        L = np.zeros((lookback, n_words), dtype=int)
+        if n_words < 2 or lookback < 1:
+            return L
+        if isinstance(self.vow, np.ndarray):
+            # Vowels and words are already integer coded (see corpus_pack)
+            vow = self.vow
+            word_ids = self.words
+        else:
+            vow = np.array([ord(c) for c in self.vow])
+            interned = {}
+            word_ids = np.array([interned.setdefault(w, len(interned))
+                                 for w in self.words])
+        tok = np.array(self.vow_word_id, dtype=int)
+        we = np.array(self.word_ends, dtype=int)
+        n_vow = len(vow)
+
+        # All (wpos1, wpos2) pairs with wpos1 = wpos2 - d >= 0
+        max_d = min(lookback, n_words-1)
+        ds = np.repeat(np.arange(1, max_d+1),
+                       n_words - np.arange(1, max_d+1))
+        w2 = np.concatenate([np.arange(d, n_words) for d in range(1, max_d+1)])
+        w1 = w2 - ds
+        p1 = we[w1]
+        p2 = we[w2]
+        dist = p2 - p1
+
+        # Run lengths of equal vowels and the last position of an identical
+        # word along each diagonal D = 1..max(dist)
+        max_dist = dist.max()
+        idx = np.arange(n_vow)
+        offsets = np.arange(1, max_dist+1)[:,None]
+        shifted = idx[None,:] + offsets
+        valid = shifted < n_vow
+        shifted = np.minimum(shifted, n_vow-1)
+        eq = valid & (vow[None,:] == vow[shifted])
+        tok_eq = valid & (tok[None,:] == tok[shifted])
+        last_diff = np.maximum.accumulate(np.where(eq, -1, idx[None,:]), axis=1)
+        last_same = np.maximum.accumulate(np.where(tok_eq, idx[None,:], -1),
+                                          axis=1)
+
+        # Rhyme continues while the vowels match...
+        rl = p1 - last_diff[dist-1, p1]
+        # ...the beginning of the lyrics is not reached and the two parts of
+        # the rhyme do not overlap...
+        rl = np.minimum(rl, np.minimum(p1+1, dist))
+        # ...and exactly the same words are not used (checked only once
+        # both parts have moved past their last words)
+        check = w1 > 0
+        k1 = p1 - we[np.maximum(w1-1, 0)]
+        k2 = p2 - we[np.maximum(w2-1, 0)]
+        j = p1 - np.maximum(k1, k2)
+        check &= j >= 0
+        ls = last_same[dist-1, np.maximum(j, 0)]
+        check &= ls >= 0
+        rl = np.where(check, np.minimum(rl, p1-ls), rl)
+
+        rl[word_ids[w1] == word_ids[w2]] = 0
+        # Ignore rhymes with length 1
+        rl[rl == 1] = 0
+        L[ds-1, w2] = rl
+        return L
+
+    def rhyme_stats_numpy(self):
+        '''
+        Vectorized version of rhyme_stats (same input and output).
+        '''
+        n_words = len(self.word_ends)
+        if n_words < 2:
+            return 0, (0,None,None)
+        L = self.rhyme_length_matrix()
+        profiling.count('rhyme_matrix_cells', L.size)
+        # rhyme_length picks the first word (the smallest wpos1, i.e. the
+        # largest offset) among equally long rhymes
+        L = L[::-1,1:]
+        best_d = self.lookback - np.argmax(L, axis=0)
+        rls = L.max(axis=0)
+        avg_rl = np.mean(rls)
+        max_rhyme = (0,None,None)
+        i = np.argmax(rls)
+        if rls[i] > 0:
+            wpos2 = i + 1
+            max_rhyme = (int(rls[i]), int(wpos2-best_d[i]), int(wpos2))
+        return avg_rl, max_rhyme
+
+    def rhyme_stats_sweep(self, max_lookback):
+        '''
+        Compute rhyme_stats for every lookback 1..max_lookback in one pass.
+        The best rhyme of a word under lookback k is the maximum over the
+        offsets d <= k, so it's a running maximum over the rows of
+        rhyme_length_matrix.
+
+        Output:
+            List where element k-1 is the output of rhyme_stats with
+            lookback k.
+        '''
+        n_words = len(self.word_ends)
+        if n_words < 2:
+            return [(0, (0,None,None))] * max_lookback
+        L = self.rhyme_length_matrix(max_lookback)[:,1:]
+        profiling.count('rhyme_matrix_cells', L.size)
+        R = np.maximum.accumulate(L, axis=0)
+        # rhyme_length picks the largest offset among equally long rhymes.
+        # The largest d <= k where L[d-1] reaches the running maximum also
+        # has the maximum of lookback k.
+        ds = np.arange(1, max_lookback+1)[:,None]
+        best_d = np.maximum.accumulate(np.where(L == R, ds, 0), axis=0)
+        avg_rls = R.mean(axis=1)
+        best_w = np.argmax(R, axis=1)
+        stats = []
+        for k in range(max_lookback):
+            i = best_w[k]
+            max_rhyme = (0,None,None)
+            if R[k,i] > 0:
+                wpos2 = i + 1
+                max_rhyme = (int(R[k,i]), int(wpos2-best_d[k,i]), int(wpos2))
+            stats.append((avg_rls[k], max_rhyme))
+        return stats
+
+    def rhyme_pairs(self, min_length=2, lookback=None):
+        '''
+        Find every pair of words within the lookback (default: self.lookback)
+        which rhyme with at least min_length vowels. Unlike rhyme_stats, all
+        rhyming pairs are returned and not only the best one of each word.
+
+        Output:
+            Integer array of shape (number of pairs, 3) with rows
+            (wpos1, wpos2, rhyme length) sorted by wpos2 and wpos1.
+        '''
+        if lookback is None:
+            lookback = self.lookback
+        L = self.rhyme_length_matrix(lookback)
+        profiling.count('rhyme_matrix_cells', L.size)
+        # Rhymes of length 1 are zeroed in the matrix
+        ds, w2 = np.nonzero(L >= max(min_length, 2))
+        order = np.lexsort((-ds, w2))
+        ds = ds[order] + 1
+        w2 = w2[order]
+        return np.column_stack((w2 - ds, w2, L[ds-1, w2])).astype(np.int32)
+
+    def compact(self):
+        '''
+        Reduce the memory usage of analyzed lyrics. The raw text and the
+        intermediate results of the preprocessing are dropped, words are
+        replaced by integer IDs (identical words share the ID) and the index
+        lists are stored as typed arrays. The rhyme stats, rhyme strings and
+        words (get_words) can still be computed, but lines cannot be
+        appended anymore.
+        '''
+        self.lean = True
+        # Join the texts extended by append_line
+        for name in list(self._appended or []):
+            getattr(self, name)
+        self.text_raw = None
+        self.lines = None
+        self._uniq_lines = None
+        self._word_ids = None
+        if len(self.language) >= 2 and self.language[:2] == 'en':
+            # Rebuilt from text_orig when needed
+            self.lines_orig = None
+            self.word_ends_orig = None
+            self.words_orig = None
+        if not isinstance(self.vow, np.ndarray):
+            self.vow = u''.join(self.vow)
+            word_ids = {}
+            self.words = array('i', [word_ids.setdefault(w, len(word_ids))
+                                     for w in self.words])
+            for name in ['vow_idxs', 'word_ends', 'line_starts',
+                         'vow_word_start', 'vow_word_end', 'vow_word_id']:
+                setattr(self, name, array('i', getattr(self, name)))
+
     def get_avg_rhyme_length(self):
         return self.avg_rhyme_length
 
+    def get_words(self):
+        '''
+        Lowercase words of the (cleaned) lyrics, used e.g. for computing the
+        vocabulary size of an artist.
+        '''
+        if self.language == 'fi':
+            return self.text.split()
+        else:
+            text = self.text_orig.lower()
+            text = NON_WORD_RE.sub(' ', text)
+            return text.split()
+
     def print_song_stats(self):
-        print '------------------------------------------'
-        print "%s\n" % self.filename
+        print self.get_song_stats()
+
+    def get_song_stats(self):
+        ret = '------------------------------------------\n'
+        ret += "%s\n\n" % self.filename
 
-        print "Avg rhyme length: %.3f\n" % self.avg_rhyme_length
+        ret += "Avg rhyme length: %.3f\n\n" % self.avg_rhyme_length
 
-        self.print_rhyme(self.longest_rhyme)
-        print
-        #print '------------------------------------------'
+        ret += self.get_rhyme_str(self.longest_rhyme) + '\n'
+        #ret += '------------------------------------------\n'
+        return ret
 
     def print_song_stats_compact(self):
         print "%.3f  %s" % (self.avg_rhyme_length, self.filename)
@@ -259,46 +843,52 @@ class Lyrics:
         rl, wpos1, wpos2 = rhyme_tuple
         if wpos1 is None or wpos2 is None:
             return ''
-        p2 = self.vow_idxs[self.word_ends[wpos2]]
-        p2_orig = p2
-        # Find the ending of the last word
-        while not ph.is_space(self.text[p2]):
-            p2 += 1
+        # The character following the last word
+        p2 = self.vow_word_end[self.word_ends[wpos2]] + 1
         p0 = self.vow_idxs[self.word_ends[wpos1]-rl]
-        p0_orig = p0
         # Find the beginning of the line
-        while self.text[p0] != '\n' and p0 > 0:
-            p0 -= 1
+        p0 = max(self.text.rfind('\n', 0, p0+1), 0)
 
         cap_line = ''
         rw1, rw2 = self.get_rhyming_vowels(rhyme_tuple)
+        rhyming = set(rw1) | set(rw2)
+        firsts = (min(rw1), min(rw2))
+        lasts = (max(rw1), max(rw2))
         for i in range(p0,p2+1):
             if self.language == 'fi':
-                if i in rw1 or i in rw2:
+                if i in rhyming:
                     cap_line += self.text[i].capitalize()
                 else:
                     cap_line += self.text[i]
             else:
-                if i == min(rw1) or i == min(rw2):
+                if i in firsts:
                     cap_line += ' | ' + self.text[i]
-                elif i == max(rw1) or i == max(rw2):
+                elif i in lasts:
                     cap_line += self.text[i] + '|'
                 else:
                     cap_line += self.text[i]
         ret += "Longest rhyme (l=%d): %s\n" % (rl, cap_line)
         if self.language != 'fi':
             # Get the corresponding lines from the original lyrics
-            line_beg = self.line_idxs[p0]
-            line_end = self.line_idxs[p2]
+            lines_orig = self.lines_orig
+            if lines_orig is None:
+                lines_orig = self.text_orig.split('\n')
+            line_beg = self.line_index(p0)
+            line_end = self.line_index(p2)
             for i in range(line_beg, line_end+1):
-                if i < len(self.lines_orig):
-                    ret += self.lines_orig[i] + '\n'
+                if i < len(lines_orig):
+                    ret += lines_orig[i] + '\n'
         return ret
 
     def get_longest_rhyme(self):
-        rhyme_str = self.get_rhyme_str(self.longest_rhyme)
-        rhyme_str += self.filename + '\n'
-        return self.longest_rhyme[0], rhyme_str
+        # The string is cached, but the longest rhyme may change (e.g. in
+        # append_line)
+        cached = getattr(self, '_longest_rhyme_str', None)
+        if cached is None or cached[0] != self.longest_rhyme:
+            rhyme_str = self.get_rhyme_str(self.longest_rhyme)
+            rhyme_str += self.filename + '\n'
+            self._longest_rhyme_str = cached = (self.longest_rhyme, rhyme_str)
+        return self.longest_rhyme[0], cached[1]
 
     def get_rhyming_vowels(self, rhyme_tuple):
         '''
@@ -2,7 +2,18 @@
 
 import os
 import codecs
-import re
+import tempfile
+import subprocess
+import sqlite3
+import hashlib
+import random
+import string
+import time
+import threading
+import collections
+from distutils.spawn import find_executable
+
+import profiling
 
 '''
 This file contains all phonetics related functions. The phonetic
@@ -13,37 +24,51 @@ For English the list of available phonetic vowels can be found here:
     http://espeak.sourceforge.net/phonemes.html
 '''
 
-def is_vow(c, language='fi'):
+# Vowels of each language. In order to increase recall for the rhyme
+# detection, we ignore the English schwa vowel '@' as it can be rhymed with
+# several different vowels. However, in BattleBot we do not ignore it in
+# order to get a higher precision.
+VOWELS = {
+        'fi': u'aeiouyäöå',
+        'en': u'3L5aAeEiI0VuUoO',
+        }
+
+# Vowels mapped to similar sounding vowels (only for English). This list is
+# somewhat arbitrary, so some native English speaker who knows about
+# phonetics might be able to improve it.
+VOWEL_MAPS = {
+        'fi': {},
+        'en': {
+            '0':'o',
+            'O':'o',
+            'I':'i',
+            'E':'e'
+            },
+        }
+
+def language_key(language):
     '''
-    Is the given (lowercase) character a vowel or not.
+    Key of the language in VOWELS and VOWEL_MAPS ('fi' or 'en').
     '''
     if language == 'fi': # Finnish
-        return c in u'aeiouyäöå'
-
+        return 'fi'
     elif len(language) >= 2 and language[:2] == 'en': # English
-        # In order to increase recall for the rhyme detection, we 
-        # ignore the schwa vowel '@' as it can be rhymed with several
-        # different vowels. However, in BattleBot we do not ignore it
-        # in order to get a higher precision.
-        return c in u'3L5aAeEiI0VuUoO'
-
+        return 'en'
     else:
         raise Exception("Unknown language: %s" % language)
 
+def is_vow(c, language='fi'):
+    '''
+    Is the given (lowercase) character a vowel or not.
+    '''
+    return c in VOWELS[language_key(language)]
+
 def map_vow(c, language):
     '''
     Map vowel to a similar sounding vowel (only for English).
     '''
-    # This list is somewhat arbitrary, so some native English speaker 
-    # who knows about phonetics might be able to improve it.
-    vow_map = {
-            '0':'o',
-            'O':'o',
-            'I':'i',
-            'E':'e'
-            }
-    if len(language) >= 2 and language[:2] == 'en' and c in vow_map:
-        return vow_map[c]
+    if len(language) >= 2 and language[:2] == 'en':
+        return VOWEL_MAPS['en'].get(c, c)
     else:
         return c
 
@@ -54,27 +79,526 @@ def is_space(c):
     '''
     return c==' ' or c=='\n'
 
-def get_phonetic_transcription(text, language='en-us', output_fname=None):
-    if output_fname is None:
-        fname2 = u'temp_transcription.txt'
-    else:
-        fname2 = output_fname
+def _temp_fname(prefix):
+    fd, fname = tempfile.mkstemp(prefix=prefix, suffix='.txt')
+    os.close(fd)
+    return fname
+
+# Options which affect the output of eSpeak (part of the cache key)
+ESPEAK_OPTIONS = '-xq'
+# Command used for starting eSpeak (the voice is appended as -v<voice>).
+# eSpeak doesn't flush its output after each line when writing to a pipe,
+# so we make its stdout line buffered with stdbuf if it's available.
+ESPEAK_COMMAND = ['espeak', ESPEAK_OPTIONS]
+if find_executable('stdbuf') is not None:
+    ESPEAK_COMMAND = ['stdbuf', '-oL'] + ESPEAK_COMMAND
+
+class EspeakProcess:
+    '''
+    A long-lived eSpeak process. Text is written to its stdin line by line
+    and the phonemes are read back from its stdout, so no temporary files or
+    new processes are needed for transcribing a song.
+
+    eSpeak may split or join the lines of its output, so the end of the
+    transcription of a text is detected by sending a sentinel line after the
+    text and waiting for the transcription of the sentinel. The sentinel is
+    a new random word for each text, so that the text can't contain it.
+    '''
+
+    def __init__(self, language='en-us', command=None):
+        if command is None:
+            command = ESPEAK_COMMAND
+        self.proc = subprocess.Popen(list(command) + ['-v%s' % language],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.rng = random.SystemRandom()
+        # Check that the process works
+        self._new_sentinel()
+
+    def _new_sentinel(self):
+        '''
+        Return a new sentinel line and its phonemes. The phonemes are read
+        before the text is sent, while nothing else is being transcribed.
+        '''
+        sentinel = u'zy%s.' % u''.join(self.rng.choice(string.ascii_lowercase)
+                                       for i in range(10))
+        self._write(sentinel + u'\n')
+        phonemes = u''
+        while len(phonemes) == 0:
+            phonemes = self._readline().strip()
+        return sentinel, phonemes
+
+    def _write(self, text):
+        self.proc.stdin.write(text.encode('utf8'))
+        self.proc.stdin.flush()
+
+    def _readline(self):
+        line = self.proc.stdout.readline()
+        if len(line) == 0:
+            raise Exception("eSpeak process exited unexpectedly")
+        return line.decode('utf8')
+
+    def transcribe(self, text):
+        '''
+        Return the raw eSpeak transcription of text.
+        '''
+        if len(text) > 0 and text[-1] != u'\n':
+            text += u'\n'
+        sentinel, sentinel_phonemes = self._new_sentinel()
+        # eSpeak stops reading when its output isn't read, so a long text is
+        # written in another thread while the output is read here
+        errors = []
+        def write():
+            try:
+                self._write(text + sentinel + u'\n')
+            except Exception as e:
+                errors.append(e)
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        # If reading fails, the writer ends when the process is killed (see
+        # EspeakPool.transcribe)
+        lines = []
+        while True:
+            line = self._readline()
+            if line.strip() == sentinel_phonemes:
+                break
+            lines.append(line)
+        writer.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return u''.join(lines)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def kill(self):
+        '''
+        Stop a process which may be in an unknown state.
+        '''
+        try:
+            self.proc.kill()
+        except OSError:
+            # Already exited
+            pass
+        self.proc.wait()
+
+class EspeakPool:
+    '''
+    A pool of long-lived eSpeak processes. The processes are started lazily
+    on the first transcription of each voice, so creating a pool is cheap
+    even if everything is found from the cached transcriptions. The pool
+    can be shared by several threads.
+    '''
+
+    def __init__(self, n_procs=1, command=None):
+        self.n_procs = n_procs
+        self.command = command
+        self.lock = threading.Condition()
+        self.idle = {} # Idle processes for each voice
+        self.n_started = {}
+
+    def _acquire(self, language):
+        with self.lock:
+            idle = self.idle.setdefault(language, [])
+            while len(idle) == 0 and \
+                    self.n_started.get(language, 0) >= self.n_procs:
+                self.lock.wait()
+            if len(idle) > 0:
+                return idle.pop()
+            self.n_started[language] = self.n_started.get(language, 0) + 1
+        try:
+            return EspeakProcess(language, self.command)
+        except:
+            with self.lock:
+                self.n_started[language] -= 1
+                self.lock.notify()
+            raise
+
+    def _release(self, language, proc):
+        with self.lock:
+            self.idle[language].append(proc)
+            self.lock.notify()
+
+    def transcribe(self, text, language='en-us'):
+        proc = self._acquire(language)
+        try:
+            new_text = proc.transcribe(text)
+        except:
+            # Don't reuse a process which is in an unknown state
+            proc.kill()
+            with self.lock:
+                self.n_started[language] -= 1
+                self.lock.notify()
+            raise
+        self._release(language, proc)
+        return new_text
+
+    def close(self):
+        with self.lock:
+            for procs in self.idle.values():
+                for proc in procs:
+                    proc.close()
+            self.idle = {}
+            self.n_started = {}
+
+class TranscriptionCache:
+    '''
+    Persistent store of raw eSpeak transcriptions in an SQLite file. The
+    entries are keyed by a hash of the (cleaned) text, the voice and the
+    eSpeak options, so edited lyrics are never matched with old phonemes.
+    When the total size of the transcriptions exceeds max_bytes, the least
+    recently used entries are evicted.
+
+    Several processes can use the same cache file.
+    '''
+
+    def __init__(self, path='transcriptions.sqlite', max_bytes=256*2**20,
+                 check_same_thread=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        # With check_same_thread=False the cache can be used by other
+        # threads than the one which created it, but not concurrently
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=check_same_thread)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS transcriptions
+                (key TEXT PRIMARY KEY, transcription TEXT,
+                 size INTEGER, last_used REAL)''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS lru
+                ON transcriptions (last_used)''')
+
+    @staticmethod
+    def key(text, language, options=ESPEAK_OPTIONS):
+        h = hashlib.sha1()
+        for part in (language, options, text):
+            h.update(part.encode('utf8'))
+            h.update('\0')
+        return h.hexdigest()
+
+    def get(self, text, language):
+        '''
+        Return the cached transcription of text or None.
+        '''
+        key = self.key(text, language)
+        row = self.conn.execute(
+                'SELECT transcription FROM transcriptions WHERE key=?',
+                (key,)).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute(
+                    'UPDATE transcriptions SET last_used=? WHERE key=?',
+                    (time.time(), key))
+        return row[0]
 
-    if output_fname is None or not os.path.exists(fname2):
-        print "Transcribing: %s" % fname2
-        fname = u'temp_lyrics.txt'
-        f = codecs.open(fname, 'w', 'utf8')
-        f.write(text)
+    def put(self, text, language, transcription):
+        size = len(transcription.encode('utf8'))
+        with self.conn:
+            self.conn.execute(
+                    '''INSERT OR REPLACE INTO transcriptions
+                    (key, transcription, size, last_used)
+                    VALUES (?, ?, ?, ?)''',
+                    (self.key(text, language), transcription, size,
+                     time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM transcriptions'
+                ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute(
+                'SELECT key, size FROM transcriptions ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.conn.executemany('DELETE FROM transcriptions WHERE key=?',
+                              evicted)
+
+    def import_sidecar(self, text, language, ipa_fname):
+        '''
+        Add an existing transcription file (<song>.txt.ipa) as the
+        transcription of text, which must be the cleaned text of the song.
+        '''
+        f = codecs.open(ipa_fname, 'r', 'utf8')
+        self.put(text, language, f.read())
         f.close()
 
-        cmd = u'espeak -xq -v%s -f %s > %s' % (language, fname, fname2)
-        os.system(cmd)
+    def close(self):
+        self.conn.close()
+
+class MemoryTranscriptionCache:
+    '''
+    Transcriptions kept in memory for a long-running process (same interface
+    as TranscriptionCache). At most max_entries transcriptions are kept and
+    the least recently used ones are evicted. If store (TranscriptionCache
+    created with check_same_thread=False) is given, transcriptions missing
+    from memory are looked up from it and new ones are added to it.
+
+    The cache can be shared by several threads.
+    '''
+
+    def __init__(self, max_entries=10000, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, text, language):
+        key = TranscriptionCache.key(text, language)
+        with self.lock:
+            transcription = self.entries.pop(key, None)
+            if transcription is None and self.store is not None:
+                transcription = self.store.get(text, language)
+            if transcription is not None:
+                self.entries[key] = transcription
+        return transcription
+
+    def put(self, text, language, transcription):
+        key = TranscriptionCache.key(text, language)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = transcription
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.store is not None:
+                self.store.put(text, language, transcription)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+class WordPhonemeDict:
+    '''
+    Persistent dictionary from words to their raw eSpeak transcriptions
+    (stored in an SQLite file, which can be the same file as the
+    TranscriptionCache). A text is transcribed word by word so that only
+    the words which haven't been seen before are sent to eSpeak, in a
+    single batch. The words of a language are kept in memory once loaded.
+
+    The result differs slightly from transcribing whole lines since eSpeak
+    doesn't see the context of the words (e.g. stress and linking sounds).
+    '''
+
+    def __init__(self, path='transcriptions.sqlite'):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS words
+                (language TEXT, word TEXT, phonemes TEXT,
+                 PRIMARY KEY (language, word))''')
+        self.words = {} # Word dictionary of each loaded language
+        # Statistics (word tokens found from the dictionary and unique
+        # words sent to eSpeak)
+        self.n_token_hits = 0
+        self.n_token_misses = 0
+        self.n_types_transcribed = 0
 
-    f2 = codecs.open(fname2, 'r', 'utf8')
-    new_text = f2.read()
+    def _load(self, language):
+        if language not in self.words:
+            rows = self.conn.execute(
+                    'SELECT word, phonemes FROM words WHERE language=?',
+                    (language,))
+            self.words[language] = dict(rows)
+        return self.words[language]
 
-    # Remove some unwanted stuff from the transcription
-    new_text = re.sub("_:'Ekskl@m,eIS@n_:", "", new_text)
-    new_text = re.sub("'", "", new_text)
-    new_text = re.sub(",", "", new_text)
+    @staticmethod
+    def word_key(word):
+        return word.strip(u'.?!').lower()
+
+    def transcribe(self, text, language='en-us', backend=None):
+        '''
+        Return the raw transcription of text with one output line for each
+        line of text.
+        '''
+        words = self._load(language)
+        lines = [[self.word_key(w) for w in line.split()]
+                 for line in text.split(u'\n')]
+        missing = set()
+        for line in lines:
+            for w in line:
+                if len(w) == 0:
+                    continue
+                if w in words:
+                    self.n_token_hits += 1
+                else:
+                    self.n_token_misses += 1
+                    missing.add(w)
+        if len(missing) > 0:
+            self.add_words(sorted(missing), language, backend)
+
+        new_lines = []
+        for line in lines:
+            phonemes = [words[w] for w in line if len(w) > 0]
+            if len(phonemes) > 0:
+                new_lines.append(u' ' + u' '.join(phonemes))
+            else:
+                new_lines.append(u'')
+        return u'\n'.join(new_lines)
+
+    def add_words(self, new_words, language='en-us', backend=None):
+        '''
+        Transcribe the given words in one batch and store them.
+
+        Each word is followed by a separator word in the batch and the
+        output is split at the transcriptions of the separator, so a word
+        which eSpeak outputs on several lines (or on none) can't shift the
+        phonemes of the other words. If the output doesn't split into one
+        part for each word (e.g. eSpeak joined two lines), nothing from the
+        batch is stored and the words are transcribed one by one instead.
+        '''
+        transcribe = run_espeak
+        if backend is not None:
+            transcribe = backend.transcribe
+        separator = u'zyxxyz'
+        while separator in new_words:
+            separator += u'z'
+        batch = separator + u'.\n' + \
+                u''.join(w + u'.\n' + separator + u'.\n' for w in new_words)
+        phonemes = self._split_batch(transcribe(batch, language),
+                                     len(new_words))
+        if phonemes is None:
+            phonemes = [u' '.join(transcribe(w + u'.\n', language).split())
+                        for w in new_words]
+        self.n_types_transcribed += len(new_words)
+        words = self._load(language)
+        for w, p in zip(new_words, phonemes):
+            words[w] = p
+        with self.conn:
+            self.conn.executemany(
+                    'INSERT OR REPLACE INTO words VALUES (?, ?, ?)',
+                    [(language, w, p) for w, p in zip(new_words, phonemes)])
+
+    @staticmethod
+    def _split_batch(output, n_words):
+        '''
+        Split the transcription of a batch of add_words into the phonemes of
+        each word.
+
+        Output:
+            List of n_words phoneme strings or None if the output doesn't
+            line up with the words.
+        '''
+        lines = [l.strip() for l in output.split(u'\n')]
+        lines = [l for l in lines if len(l) > 0]
+        # The first line is the transcription of the separator alone
+        if len(lines) == 0:
+            return None
+        separator = lines[0]
+        parts = [[]]
+        for l in lines[1:]:
+            if l == separator:
+                parts.append([])
+            else:
+                parts[-1].extend(l.split())
+        # Each word is followed by the separator, so the last part is empty
+        if len(parts) != n_words + 1 or len(parts[-1]) > 0:
+            return None
+        return [u' '.join(p) for p in parts[:-1]]
+
+    def close(self):
+        self.conn.close()
+
+def get_phonetic_transcription(text, language='en-us', output_fname=None,
+                               backend=None, cache=None, word_dict=None,
+                               transcription=None):
+    '''
+    Transcribe text using eSpeak. If output_fname is given, the
+    transcription is stored to that file and reused if the file already
+    exists.
+
+    If backend (e.g. EspeakPool) is given, the text is transcribed by its
+    long-lived eSpeak processes instead of starting a new eSpeak process.
+
+    If cache (TranscriptionCache) is given, it's used instead of the
+    output_fname file.
+
+    If word_dict (WordPhonemeDict) is given, the text is transcribed word by
+    word using the dictionary instead of the cache or the file.
+
+    If transcription is given, it's used as the content of the output_fname
+    file which has been read already.
+    '''
+    if word_dict is not None:
+        n_hits = word_dict.n_token_hits
+        n_misses = word_dict.n_token_misses
+        new_text = word_dict.transcribe(text, language, backend)
+        profiling.count('word_dict_token_hits', word_dict.n_token_hits - n_hits)
+        profiling.count('word_dict_token_misses',
+                        word_dict.n_token_misses - n_misses)
+    elif cache is not None:
+        new_text = cache.get(text, language)
+        if new_text is not None:
+            profiling.count('transcription_cache_hits')
+        else:
+            profiling.count('transcription_cache_misses')
+            if backend is not None:
+                new_text = backend.transcribe(text, language)
+            else:
+                new_text = run_espeak(text, language)
+            cache.put(text, language, new_text)
+    elif output_fname is not None and transcription is not None:
+        profiling.count('transcription_file_hits')
+        new_text = transcription
+    elif output_fname is not None and os.path.exists(output_fname):
+        profiling.count('transcription_file_hits')
+        f2 = codecs.open(output_fname, 'r', 'utf8')
+        new_text = f2.read()
+        f2.close()
+    else:
+        profiling.count('transcription_file_misses')
+        if output_fname is not None:
+            print "Transcribing: %s" % output_fname
+        if backend is not None:
+            new_text = backend.transcribe(text, language)
+        else:
+            new_text = run_espeak(text, language)
+        if output_fname is not None:
+            f2 = codecs.open(output_fname, 'w', 'utf8')
+            f2.write(new_text)
+            f2.close()
+    return clean_transcription(new_text)
+
+def run_espeak(text, language='en-us', command=None):
+    '''
+    Transcribe text by starting a new eSpeak process (command, by default
+    espeak with ESPEAK_OPTIONS). The temporary file is unique to each call
+    so that several processes can transcribe at the same time. An exception
+    is raised if eSpeak can't be run or it fails, so that the failure isn't
+    stored as an empty transcription.
+    '''
+    if command is None:
+        command = ['espeak', ESPEAK_OPTIONS]
+    fname = _temp_fname('temp_lyrics_')
+    f = codecs.open(fname, 'w', 'utf8')
+    f.write(text)
+    f.close()
+    try:
+        proc = subprocess.Popen(list(command) + ['-v%s' % language, '-f',
+                                                 fname],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, errors = proc.communicate()
+    except OSError as e:
+        raise Exception("eSpeak could not be run: %s" % e)
+    finally:
+        os.remove(fname)
+    if proc.returncode != 0:
+        raise Exception("eSpeak failed with exit status %d: %s" %
+                        (proc.returncode, errors.strip()))
+    return output.decode('utf8')
+
+def clean_transcription(new_text):
+    '''
+    Remove some unwanted stuff from the raw eSpeak transcription.
+    '''
+    new_text = new_text.replace("_:'Ekskl@m,eIS@n_:", "")
+    new_text = new_text.replace("'", "")
+    new_text = new_text.replace(",", "")
     return new_text
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import json
+import codecs
+from timeit import default_timer as timer
+
+'''
+Optional instrumentation of the analysis. Profiling is disabled by default
+and then the hooks (stage and count) only check a module variable.
+
+Usage:
+    sink = profiling.JsonSink('profile.json', 'profile_songs.jsonl')
+    read_lyrics(..., profile_sink=sink)
+
+or, for a single Lyrics object:
+    prof = profiling.enable()
+    l = Lyrics(...)
+    profiling.disable()
+    print prof.report()
+'''
+
+# The active Profiler (None if profiling is disabled)
+active = None
+
+class Profiler:
+    '''
+    Collects the wall time of each stage, counters of the work done in the
+    inner loops and per-song records.
+    '''
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.songs = []
+
+    def add_time(self, stage, seconds):
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def song_record(self, song):
+        return {'song': song, 'times': self.times, 'counts': self.counts,
+                'total': sum(self.times.values())}
+
+    def add_song(self, record):
+        '''
+        Add a per-song record (see song_record) to the totals.
+        '''
+        for stage, seconds in record['times'].items():
+            self.add_time(stage, seconds)
+        for name, n in record['counts'].items():
+            self.count(name, n)
+        self.songs.append(record)
+
+    def report(self, n_slowest=10):
+        stages = sorted(self.times.items(), key=lambda x: -x[1])
+        slowest = sorted(self.songs, key=lambda r: -r['total'])[:n_slowest]
+        return {'stages': [{'stage': s, 'seconds': t} for s, t in stages],
+                'counts': self.counts,
+                'songs': len(self.songs),
+                'slowest_songs': [{'song': r['song'], 'seconds': r['total']}
+                                  for r in slowest]}
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, timer() - self.start)
+
+class _NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_null_stage = _NullStage()
+
+def stage(name):
+    '''
+    Context manager which adds the time spent in the block to the given
+    stage.
+    '''
+    if active is None:
+        return _null_stage
+    return _Stage(active, name)
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
+
+def enable():
+    global active
+    active = Profiler()
+    return active
+
+def disable():
+    global active
+    profiler = active
+    active = None
+    return profiler
+
+class JsonSink:
+    '''
+    Writes the report of a run as JSON and the per-song records as JSON
+    lines (if songs_fname is given).
+    '''
+
+    def __init__(self, report_fname, songs_fname=None):
+        self.report_fname = report_fname
+        self.songs_fname = songs_fname
+
+    def write(self, profiler):
+        f = open(self.report_fname, 'w')
+        json.dump(profiler.report(), f, indent=1)
+        f.close()
+        if self.songs_fname is not None:
+            f = codecs.open(self.songs_fname, 'w', 'utf8')
+            for record in profiler.songs:
+                f.write(json.dumps(record, ensure_ascii=False) + u'\n')
+            f.close()
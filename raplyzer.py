@@ -3,14 +3,38 @@ import codecs
 import re
 import numpy as np
 import os
+import sys
 import heapq
 import datetime as dt
 import json
+import itertools
+import multiprocessing
+import sqlite3
+import hashlib
+import zlib
+import csv
+import threading
+from timeit import default_timer as timer
 
 from lyrics import Lyrics
+from corpus_pack import CorpusPack, write_pack
+import rhyme_index
+import corpus_loader
+from vocabulary import VocabularyCounter
+import phonetics as ph
+import profiling
+
+# The vocabulary size of an artist is the number of unique words among the
+# first VOCABULARY_WORDS words, so no more words need to be kept
+VOCABULARY_WORDS = 20000
 
 def read_lyrics(lyrics_dir='lyrics_en', artist=None, album=None, 
-                print_stats=False, language='en-us', lookback=15):
+                print_stats=False, language='en-us', lookback=15,
+                engine='loop', workers=1, espeak_procs=0,
+                transcription_cache=None, word_phonemes=None,
+                result_store=None, pack=None, profile_sink=None,
+                shard_file=None, shard=None, shard_by='artist',
+                shard_artists=None, read_ahead=16, io_threads=4):
     '''
     Read lyrics and compute Rhyme factor (riimikerroin) for each
     artist.
@@ -26,94 +50,1193 @@ def read_lyrics(lyrics_dir='lyrics_en', artist=None, album=None,
                     or English (en).
         lookback    How many previous words are checked for rhymes. For
                     Finnish I've used 10 and for English 15.
+        engine      Rhyme engine used by Lyrics: 'loop' or 'numpy' (faster,
+                    gives the same results).
+        workers     Number of processes used for analyzing the songs. The
+                    results do not depend on the number of workers.
+        espeak_procs If > 0, songs without a stored transcription are
+                    transcribed with this many long-lived eSpeak processes
+                    (per worker) instead of starting eSpeak for each song.
+        transcription_cache Path to a phonetics.TranscriptionCache file
+                    which is used instead of the <song>.txt.ipa files.
+        word_phonemes Path to a phonetics.WordPhonemeDict file. If given,
+                    the songs are transcribed word by word using it.
+        result_store Path to a SongResultStore file. Only the songs which
+                    are new or have changed since the previous run are
+                    analyzed, and the songs which no longer exist under the
+                    analyzed directory are removed from the store. With a
+                    pack, the songs are compared by their content in the
+                    pack.
+        pack        Path to a pack file (see export_pack). If given, the
+                    preprocessed songs are read from the pack instead of
+                    lyrics_dir.
+        profile_sink If given (e.g. profiling.JsonSink), the run is profiled
+                    and the stage times, counters and per-song records are
+                    written to the sink.
+        shard_file  If given, only a shard of the corpus is analyzed and its
+                    results (see CorpusResults) are written to this file
+                    instead of printing the rankings. The shard files of a
+                    corpus are combined with merge_shards.
+        shard       Tuple (i, n): analyze shard i of n, chosen by the hash
+                    of the artist name or of the song file name (see
+                    shard_by).
+        shard_by    'artist' or 'song'.
+        shard_artists List of the artists to be analyzed (instead of shard).
+        read_ahead  Number of songs which are read ahead of the analysis
+                    (see corpus_loader.read_songs). 0 reads each song only
+                    when it's analyzed.
+        io_threads  Number of threads reading the songs ahead.
+    '''
+    start = timer()
+    profiler = None
+    if profile_sink is not None:
+        profiler = profiling.enable()
+    with profiling.stage('read_lyrics.list_songs'):
+        song_lists = _song_lists(lyrics_dir, artist, album, language, pack)
+    file_names = [file_name for a, albums in song_lists
+                  for al, songs in albums
+                  for file_name in songs]
+    select_artist, select_song = _shard_filters(shard, shard_by,
+                                                shard_artists)
+    selected = [file_name for a, albums in song_lists if select_artist(a)
+                for al, songs in albums
+                for file_name in songs if select_song(file_name)]
+    store = None
+    cached = {}
+    if result_store is not None:
+        store = SongResultStore(result_store)
+        # Word by word transcriptions give slightly different results
+        variant = 'words' if word_phonemes is not None else ''
+        with profiling.stage('read_lyrics.result_store'):
+            if pack is not None:
+                content_hash = CorpusPack(pack).content_hash
+            else:
+                content_hash = lambda file_name: store.content_hash(
+                        file_name, language)
+            hashes = dict((file_name, content_hash(file_name))
+                          for file_name in selected)
+            cached = store.get_results(hashes, language, lookback, variant)
+    todo = [file_name for file_name in selected if file_name not in cached]
+    window = None
+    if pack is None and read_ahead > 0:
+        # The stored transcriptions aren't needed with the caches
+        loaded = corpus_loader.read_songs(
+                todo, language,
+                transcription_cache is None and word_phonemes is None,
+                io_threads, read_ahead)
+        window = read_ahead + workers
+    else:
+        loaded = ((file_name, None, None, None) for file_name in todo)
+    # The summaries are stored so that they can be printed on later runs
+    tasks = ((file_name, language, lookback, engine,
+              print_stats or store is not None, profiler is not None, text,
+              transcription, read_time)
+             for file_name, text, transcription, read_time in loaded)
+    pool = start_workers(workers, espeak_procs, transcription_cache,
+                         word_phonemes, pack)
+    results = map_tasks(pool, analyze_song_task, tasks, window)
+    completed = False
+    try:
+        corpus = CorpusResults(language, lookback, song_lists)
+        songs_start = timer()
+        song_idx = 0
+        for artist_idx, (a, albums) in enumerate(song_lists):
+            if not select_artist(a):
+                song_idx += sum(len(songs) for al, songs in albums)
+                continue
+            print "Analyzing artist: %s" % _utf8(a)
+            corpus.add_artist(artist_idx, a)
+            for al, songs in albums:
+                for file_name in songs:
+                    song_idx += 1
+                    if not select_song(file_name):
+                        continue
+                    if file_name in cached:
+                        res = cached[file_name]
+                    else:
+                        res = next(results)
+                        if profiler is not None:
+                            profiler.add_song(res.pop('profile'))
+                        if store is not None:
+                            store.put(file_name, hashes[file_name], language,
+                                      lookback, variant, res)
+                    if print_stats:
+                        print res['stats']
+                    corpus.add_song(song_idx-1, artist_idx, file_name, res)
+                # Print stats for the album
+                #print "%s - %s: %.3f" % (a, al, np.mean(np.array(album_rls)))
+                #print "%.5f" % (np.mean(np.array(album_rls)))
+        completed = True
+    finally:
+        # After an error, stop the workers and the threads reading the songs
+        # without waiting for the remaining songs
+        if hasattr(results, 'close'):
+            results.close()
+        stop_workers(pool, terminate=not completed)
+        loaded.close()
+        if store is not None and not completed:
+            store.close()
+    if store is not None:
+        # Remove the songs which have been deleted
+        prefix = lyrics_dir
+        if artist is not None:
+            prefix = os.path.join(prefix, artist)
+            if album is not None:
+                prefix = os.path.join(prefix, album)
+        store.prune(prefix, file_names)
+        store.close()
+    if profiler is not None:
+        profiler.add_time('read_lyrics.songs', timer() - songs_start)
+
+    if shard_file is not None:
+        corpus.save(shard_file)
+    else:
+        corpus.print_rankings()
+
+    if profiler is not None:
+        profiling.disable()
+        profiler.add_time('read_lyrics.total', timer() - start)
+        profile_sink.write(profiler)
+
+def _utf8(name):
+    # The names listed from a pack are unicode, the others byte strings
+    if isinstance(name, unicode):
+        return name.encode('utf8')
+    return name
+
+def _shard_filters(shard, shard_by, shard_artists):
+    # Functions telling whether an artist and a song belong to the shard
+    def hashed(name):
+        return (zlib.crc32(_utf8(name)) & 0xffffffff) % shard[1] == shard[0]
+    def everything(name):
+        return True
+    if shard_artists is not None:
+        shard_artists = set(_utf8(a) for a in shard_artists)
+        return (lambda a: _utf8(a) in shard_artists), everything
+    if shard is None:
+        return everything, everything
+    if shard_by == 'artist':
+        return hashed, everything
+    if shard_by == 'song':
+        # Every shard lists all artists so that artists without songs are
+        # ranked as in a single run
+        return everything, hashed
+    raise Exception("Unknown shard_by: %s" % shard_by)
+
+def merge_shards(shard_files, print_rankings=True):
+    '''
+    Combine the results of read_lyrics shards (see read_lyrics and
+    CorpusResults). The rankings are identical to those of a single run over
+    the whole corpus.
+
+    Output:
+        The merged CorpusResults.
+    '''
+    corpus = None
+    for fname in shard_files:
+        shard = CorpusResults.load(fname)
+        if corpus is None:
+            corpus = shard
+        else:
+            corpus.merge(shard)
+    if corpus is None:
+        raise Exception("No shard files given")
+    corpus.check_complete()
+    if print_rankings:
+        corpus.print_rankings()
+    return corpus
+
+class CorpusResults:
+    '''
+    Results of read_lyrics for (a shard of) a corpus: the average rhyme
+    length of each song, the sums and counts of the rhyme lengths of each
+    artist, the vocabulary of the first VOCABULARY_WORDS words of each
+    artist and the best rhymes.
+
+    The songs and artists are identified by their positions in the listing
+    of the whole corpus, so the results of shards can be merged in any order
+    and still ranked exactly as in a single run. All shards must see the
+    same listing (the same lyrics_dir path and files).
+    '''
+
+    def __init__(self, language, lookback, song_lists=None, max_rhymes=5):
+        self.language = language
+        self.lookback = lookback
+        self.max_rhymes = max_rhymes
+        self.listing = None
+        self.n_artists = self.n_songs = 0
+        if song_lists is not None:
+            h = hashlib.sha1()
+            for a, albums in song_lists:
+                h.update(_utf8(a) + '\0')
+                for al, songs in albums:
+                    for file_name in songs:
+                        h.update(_utf8(file_name) + '\0')
+                        self.n_songs += 1
+            self.listing = h.hexdigest()
+            self.n_artists = len(song_lists)
+        # Artist index -> dict with keys artist, rl_sum, songs and vocabulary
+        # (list of [first song index, last song index + 1,
+        # VocabularyCounter] of the runs of consecutive songs)
+        self.artists = {}
+        # (song index, artist index, file name, avg rhyme length) tuples
+        self.songs = []
+        # Heap of (rhyme length, rhyme string) tuples
+        self.best_rhymes = []
+
+    def add_artist(self, artist_idx, artist):
+        if artist_idx not in self.artists:
+            # Byte strings as in load
+            self.artists[artist_idx] = {'artist': _utf8(artist), 'rl_sum': 0.0,
+                                        'songs': 0, 'vocabulary': []}
+
+    def add_song(self, song_idx, artist_idx, file_name, res):
+        '''
+        Add the result of analyze_song. The songs of an artist must be added
+        in their order.
+        '''
+        a = self.artists[artist_idx]
+        rl = res['avg_rhyme_length']
+        self.songs.append((song_idx, artist_idx, _utf8(file_name), rl))
+        a['rl_sum'] += rl
+        a['songs'] += 1
+        runs = a['vocabulary']
+        if len(runs) == 0 or runs[-1][1] != song_idx:
+            runs.append([song_idx, song_idx,
+                         VocabularyCounter(VOCABULARY_WORDS)])
+        runs[-1][2].add(res['words'])
+        runs[-1][1] = song_idx + 1
+        self._add_rhyme(tuple(res['longest_rhyme_str']))
+
+    def _add_rhyme(self, rhyme):
+        if len(self.best_rhymes) < self.max_rhymes:
+            heapq.heappush(self.best_rhymes, rhyme)
+        else:
+            heapq.heappushpop(self.best_rhymes, rhyme)
+
+    def merge(self, other):
+        if (other.language, other.lookback, other.listing) != \
+                (self.language, self.lookback, self.listing):
+            raise Exception("The shards have different parameters or song "
+                            "listings")
+        song_idxs = set(s[0] for s in self.songs)
+        if any(s[0] in song_idxs for s in other.songs):
+            raise Exception("The shards have common songs")
+        self.songs += other.songs
+        for artist_idx, b in other.artists.items():
+            self.add_artist(artist_idx, b['artist'])
+            a = self.artists[artist_idx]
+            a['rl_sum'] += b['rl_sum']
+            a['songs'] += b['songs']
+            # Join the runs of songs which have become consecutive
+            runs = sorted(a['vocabulary'] + b['vocabulary'],
+                          key=lambda run: run[0])
+            a['vocabulary'] = []
+            for run in runs:
+                if len(a['vocabulary']) > 0 and \
+                        a['vocabulary'][-1][1] == run[0]:
+                    a['vocabulary'][-1][2].extend(run[2])
+                    a['vocabulary'][-1][1] = run[1]
+                else:
+                    a['vocabulary'].append(list(run))
+        for rhyme in other.best_rhymes:
+            self._add_rhyme(rhyme)
+
+    def check_complete(self):
+        if len(self.songs) != self.n_songs or \
+                len(self.artists) != self.n_artists:
+            raise Exception("Songs or artists are missing: %d/%d songs, "
+                            "%d/%d artists" % (len(self.songs), self.n_songs,
+                                               len(self.artists),
+                                               self.n_artists))
+
+    def rankings(self):
+        '''
+        Output:
+            Dict with keys:
+                artists     List of (artist, avg rhyme length, number of
+                            unique words) tuples, best first. The number of
+                            unique words is negative if the artist has less
+                            than VOCABULARY_WORDS words.
+                vocabulary  List of the vocabulary summaries of the artists
+                            in the same order (see
+                            VocabularyCounter.summary).
+                songs       List of (file name, avg rhyme length) tuples,
+                            best first.
+                best_rhymes List of (rhyme length, rhyme string) tuples,
+                            longest first.
+        '''
+        artist_idxs = sorted(self.artists)
+        artist_rls = dict((i, []) for i in artist_idxs)
+        songs = sorted(self.songs)
+        for song_idx, artist_idx, file_name, rl in songs:
+            artist_rls[artist_idx].append(rl)
+        artists = []
+        artist_scores = []
+        uniq_words = []
+        vocabularies = []
+        for i in artist_idxs:
+            a = self.artists[i]
+            artists.append(a['artist'])
+            artist_scores.append(np.mean(np.array(artist_rls[i])))
+            # The words of the songs in their order (also if some songs are
+            # missing)
+            runs = a['vocabulary']
+            if len(runs) == 1:
+                vocabulary = runs[0][2]
+            else:
+                vocabulary = VocabularyCounter(VOCABULARY_WORDS)
+                for run in runs:
+                    vocabulary.extend(run[2])
+            # The number of unique words the artist has used
+            if vocabulary.is_full():
+                uniq_words.append(vocabulary.n_unique())
+            else:
+                uniq_words.append(-vocabulary.n_words)
+            vocabularies.append(vocabulary.summary())
+
+        # Sort the artists based on their avg rhyme lengths
+        artist_scores = np.array(artist_scores)
+        artists = np.array(artists)
+        uniq_words = np.array(uniq_words)
+        order = np.argsort(artist_scores)[::-1]
+        artists = artists[order]
+        uniq_words = uniq_words[order]
+        artist_scores = artist_scores[order]
+        vocabularies = [vocabularies[i] for i in order]
+
+        song_scores = np.array([rl for s, a, f, rl in songs])
+        song_names = np.array([f for s, a, f, rl in songs])
+        song_names = song_names[np.argsort(song_scores)[::-1]]
+        song_scores = sorted(song_scores)[::-1]
+        return {'artists': zip(artists, artist_scores, uniq_words),
+                'vocabulary': vocabularies,
+                'songs': zip(song_names, song_scores),
+                'best_rhymes': sorted(self.best_rhymes)[::-1]}
+
+    def print_rankings(self):
+        rankings = self.rankings()
+        print "\nBest rhymes"
+        for l, rhyme in rankings['best_rhymes'][::-1]:
+            print rhyme
+
+        print "\nBest songs:"
+        for file_name, score in rankings['songs'][:10]:
+            print '%.3f\t%s' % (score, file_name)
+
+        print "\nBest artists:"
+        for i, (a, score, n_uniq_words) in enumerate(rankings['artists']):
+            name = a.replace('_', ' ')
+            print '%d.\t%.3f\t%s' % (i+1, score, name)
+
+    def save(self, fname):
+        data = {'language': self.language, 'lookback': self.lookback,
+                'max_rhymes': self.max_rhymes, 'listing': self.listing,
+                'n_artists': self.n_artists, 'n_songs': self.n_songs,
+                'artists': [(i, dict(a, vocabulary=[
+                                [start, end, v.to_dict()]
+                                for start, end, v in a['vocabulary']]))
+                            for i, a in sorted(self.artists.items())],
+                'songs': self.songs, 'best_rhymes': self.best_rhymes}
+        f = open(fname, 'w')
+        json.dump(data, f)
+        f.close()
+
+    @staticmethod
+    def load(fname):
+        f = open(fname)
+        data = json.load(f)
+        f.close()
+        corpus = CorpusResults(data['language'], data['lookback'],
+                               max_rhymes=data['max_rhymes'])
+        corpus.listing = data['listing']
+        corpus.n_artists = data['n_artists']
+        corpus.n_songs = data['n_songs']
+        # The names are byte strings in a single run
+        for artist_idx, a in data['artists']:
+            a['artist'] = a['artist'].encode('utf8')
+            a['vocabulary'] = [[start, end, VocabularyCounter.from_dict(v)]
+                               for start, end, v in a['vocabulary']]
+            corpus.artists[artist_idx] = a
+        corpus.songs = [(s, a, f.encode('utf8'), rl)
+                        for s, a, f, rl in data['songs']]
+        corpus.best_rhymes = [tuple(r) for r in data['best_rhymes']]
+        heapq.heapify(corpus.best_rhymes)
+        return corpus
+
+def sweep_lookbacks(lyrics_dir='lyrics_en', artist=None, album=None,
+                    language='en-us', max_lookback=30, workers=1,
+                    espeak_procs=0, transcription_cache=None,
+                    word_phonemes=None, pack=None):
+    '''
+    Compute the results of read_lyrics for every lookback 1..max_lookback.
+    Each song is read, cleaned and transcribed only once and the rhyme
+    lengths for all lookbacks are computed in one pass (see
+    Lyrics.rhyme_stats_sweep). The other arguments are as in read_lyrics.
+
+    Output:
+        List where element k-1 is a dict with the results of lookback k:
+            lookback    k
+            songs       List of (file name, avg rhyme length) tuples in the
+                        order of the songs.
+            artists     List of (artist, avg rhyme length) tuples sorted by
+                        the rhyme length (best first).
+            best_rhymes The 5 longest rhymes as (length, rhyme string)
+                        tuples (longest first).
+    '''
+    song_lists = _song_lists(lyrics_dir, artist, album, language, pack)
+    tasks = [(file_name, language, max_lookback)
+             for a, albums in song_lists
+             for al, songs in albums
+             for file_name in songs]
+    pool = start_workers(workers, espeak_procs, transcription_cache,
+                         word_phonemes, pack)
+    results = map_tasks(pool, sweep_song_task, tasks)
+
+    max_rhymes = 5
+    sweep = [{'lookback': k, 'songs': [], 'artists': [], 'best_rhymes': []}
+             for k in range(1, max_lookback+1)]
+    for a, albums in song_lists:
+        rls = [[] for k in range(max_lookback)]
+        for al, songs in albums:
+            for file_name in songs:
+                res = next(results)
+                for k in range(max_lookback):
+                    rl = res['avg_rhyme_lengths'][k]
+                    rls[k].append(rl)
+                    sweep[k]['songs'].append((file_name, rl))
+                    longest_rhymes = sweep[k]['best_rhymes']
+                    if len(longest_rhymes) < max_rhymes:
+                        heapq.heappush(longest_rhymes,
+                                       res['longest_rhyme_strs'][k])
+                    else:
+                        heapq.heappushpop(longest_rhymes,
+                                          res['longest_rhyme_strs'][k])
+        for k in range(max_lookback):
+            sweep[k]['artists'].append((a, np.mean(np.array(rls[k]))))
+    stop_workers(pool)
+
+    for results_k in sweep:
+        # Same order as in read_lyrics
+        scores = np.array([score for a, score in results_k['artists']])
+        order = np.argsort(scores)[::-1]
+        results_k['artists'] = [results_k['artists'][i] for i in order]
+        results_k['best_rhymes'] = sorted(results_k['best_rhymes'])[::-1]
+    return sweep
+
+# Fields of the rhyme pair records written by extract_rhymes
+PAIR_FIELDS = ['song', 'wpos1', 'wpos2', 'length']
+
+def extract_rhymes(lyrics_dir='lyrics_en', artist=None, album=None,
+                   language='en-us', lookback=15, min_length=3, k=10,
+                   pair_file=None, workers=1, espeak_procs=0,
+                   transcription_cache=None, word_phonemes=None, pack=None):
+    '''
+    Find every rhyme pair of at least min_length vowels (see
+    Lyrics.rhyme_pairs) and the k longest rhymes of each artist and of the
+    whole corpus. Only the pairs which end up in the top k are rendered
+    with Lyrics.get_rhyme_str, so their songs are read once more at the end.
+    The other arguments are as in read_lyrics.
+
+    Input:
+        min_length  Minimum rhyme length (in vowels) of the pairs.
+        k           Number of the longest rhymes kept for each artist and
+                    for the corpus.
+        pair_file   File object to which every pair is written as a CSV row
+                    with PAIR_FIELDS (the pairs are not kept in memory).
+
+    Output:
+        Dict with keys:
+            n_pairs     Number of rhyme pairs found.
+            corpus      The k longest rhymes of the corpus.
+            artists     List of (artist, the k longest rhymes of the artist)
+                        tuples in the order of the artists.
+        The rhymes are dicts with keys song, wpos1, wpos2, length and
+        rhyme_str, longest first. Equally long rhymes are in the order of
+        the songs and the words, so the results do not depend on the number
+        of workers.
+    '''
+    song_lists = _song_lists(lyrics_dir, artist, album, language, pack)
+    file_names = [file_name for a, albums in song_lists
+                  for al, songs in albums
+                  for file_name in songs]
+    tasks = [(file_name, language, lookback, min_length, k,
+              pair_file is not None)
+             for file_name in file_names]
+    pool = start_workers(workers, espeak_procs, transcription_cache,
+                         word_phonemes, pack)
+    results = map_tasks(pool, song_rhyme_pairs_task, tasks)
+
+    writer = None
+    if pair_file is not None:
+        writer = csv.writer(pair_file)
+        writer.writerow(PAIR_FIELDS)
+    n_pairs = 0
+    # Bounded min-heaps of (length, -song, -wpos2, -wpos1) so that the
+    # weakest rhyme is popped first
+    corpus_heap = []
+    artist_heaps = []
+    song_idx = 0
+    for a, albums in song_lists:
+        heap = []
+        for al, songs in albums:
+            for file_name in songs:
+                res = next(results)
+                n_pairs += res['n_pairs']
+                if writer is not None:
+                    name = file_name.encode('utf8') \
+                            if isinstance(file_name, unicode) else file_name
+                    writer.writerows([name] + row
+                                     for row in res['pairs'].tolist())
+                # The top k of the song contains every pair of the song
+                # which can be in the top k of the artist or the corpus
+                for wpos1, wpos2, length in res['top'].tolist():
+                    item = (length, -song_idx, -wpos2, -wpos1)
+                    for h in (heap, corpus_heap):
+                        if len(h) < k:
+                            heapq.heappush(h, item)
+                        elif item > h[0]:
+                            heapq.heapreplace(h, item)
+                song_idx += 1
+        artist_heaps.append((a, heap))
+
+    # Render the rhymes of the top k lists, reading each song only once
+    song_rhymes = {}
+    for h in [corpus_heap] + [heap for a, heap in artist_heaps]:
+        for length, s, wpos2, wpos1 in h:
+            song_rhymes.setdefault(-s, set()).add((-wpos1, -wpos2, length))
+    render_songs = sorted(song_rhymes)
+    render_tasks = [(file_names[s], language, sorted(song_rhymes[s]))
+                    for s in render_songs]
+    rhyme_strs = {}
+    for s, task, strs in zip(render_songs, render_tasks,
+                             map_tasks(pool, render_rhymes_task,
+                                       render_tasks)):
+        for rhyme, rhyme_str in zip(task[2], strs):
+            rhyme_strs[(s,) + rhyme] = rhyme_str
+    stop_workers(pool)
+
+    def top_list(h):
+        rhymes = []
+        for length, s, wpos2, wpos1 in sorted(h, reverse=True):
+            rhymes.append({'song': file_names[-s], 'wpos1': -wpos1,
+                           'wpos2': -wpos2, 'length': length,
+                           'rhyme_str': rhyme_strs[(-s, -wpos1, -wpos2,
+                                                    length)]})
+        return rhymes
+
+    return {
+            'n_pairs': n_pairs,
+            'corpus': top_list(corpus_heap),
+            'artists': [(a, top_list(heap)) for a, heap in artist_heaps],
+            }
+
+def analyze_texts(items, lookback=None, engine='loop', workers=1,
+                  espeak_procs=0, transcription_cache=None,
+                  word_phonemes=None):
+    '''
+    Analyze lyrics given in memory (e.g. rows of a database query) instead
+    of a directory of files. Nothing is printed and no files are created
+    (English transcriptions are stored only to transcription_cache if it's
+    given).
+
+    Input:
+        items       Iterable of (id, text, language) or (id, text, language,
+                    artist) tuples.
+        lookback    How many previous words are checked for rhymes (default:
+                    10 for Finnish and 15 for English).
+        The other arguments are as in read_lyrics.
+
+    Output:
+        records     List of dicts (one per item, in the same order) with
+                    keys id, artist, language, lookback, avg_rhyme_length,
+                    longest_rhyme (tuple, see Lyrics.rhyme_stats),
+                    longest_rhyme_str and n_words.
+        artists     List of dicts (one per artist and language, in the order
+                    of first appearance) with keys artist, language, songs,
+                    avg_rhyme_length, n_uniq_words (computed as in
+                    read_lyrics), n_hapax_words (number of words used
+                    once among the same words) and the longest_rhyme_str
+                    and id of the longest rhyme.
+    '''
+    tasks = (_text_task(item, lookback, engine) for item in items)
+    pool = start_workers(workers, espeak_procs, transcription_cache,
+                         word_phonemes)
+    results = map_tasks(pool, analyze_text_task, tasks)
+
+    records = []
+    artists = []
+    artist_idxs = {}
+    vocabularies = []
+    for record in results:
+        words = record.pop('words')
+        records.append(record)
+        key = (record['artist'], record['language'])
+        if key not in artist_idxs:
+            artist_idxs[key] = len(artists)
+            artists.append({'artist': record['artist'],
+                            'language': record['language'], 'rls': [],
+                            'longest_rhyme': (-1, None)})
+            vocabularies.append(VocabularyCounter(VOCABULARY_WORDS))
+        i = artist_idxs[key]
+        artists[i]['rls'].append(record['avg_rhyme_length'])
+        if record['longest_rhyme'][0] > artists[i]['longest_rhyme'][0]:
+            artists[i]['longest_rhyme'] = (record['longest_rhyme'][0],
+                                           record['id'])
+            artists[i]['longest_rhyme_str'] = record['longest_rhyme_str']
+        vocabularies[i].add(words)
+    stop_workers(pool)
+
+    for aggregate, vocabulary in zip(artists, vocabularies):
+        rls = aggregate.pop('rls')
+        aggregate['songs'] = len(rls)
+        aggregate['avg_rhyme_length'] = float(np.mean(np.array(rls)))
+        # Negative if the artist has less than VOCABULARY_WORDS words (as in
+        # read_lyrics)
+        if vocabulary.is_full():
+            aggregate['n_uniq_words'] = vocabulary.n_unique()
+        else:
+            aggregate['n_uniq_words'] = -vocabulary.n_words
+        aggregate['n_hapax_words'] = vocabulary.n_hapax()
+        aggregate['longest_rhyme_id'] = aggregate.pop('longest_rhyme')[1]
+    return records, artists
+
+def _text_task(item, lookback, engine):
+    if len(item) == 3:
+        item_id, text, language = item
+        artist = None
+    else:
+        item_id, text, language, artist = item
+    if lookback is None:
+        lookback = 10 if language == 'fi' else 15
+    return (item_id, text, language, artist, lookback, engine)
+
+# Fields of the records of analyze_texts in CSV files. The longest rhyme
+# tuple is split into three columns.
+RECORD_FIELDS = ['id', 'artist', 'language', 'lookback', 'avg_rhyme_length',
+                 'longest_rhyme_length', 'longest_rhyme_wpos1',
+                 'longest_rhyme_wpos2', 'longest_rhyme_str', 'n_words']
+
+def write_jsonl(records, f):
+    '''
+    Write records (e.g. the output of analyze_texts) to file object f as
+    JSON lines (UTF-8). Byte strings in the records are read as UTF-8.
+    '''
+    for record in records:
+        line = json.dumps(_decode_utf8(record), ensure_ascii=False)
+        f.write(line.encode('utf8') + '\n')
+
+def _decode_utf8(value):
+    # json.dumps with ensure_ascii=False doesn't decode byte strings, so
+    # mixing non-ASCII byte strings with unicode would fail
+    if isinstance(value, str):
+        return value.decode('utf8')
+    if isinstance(value, dict):
+        return dict((_decode_utf8(k), _decode_utf8(v))
+                    for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_decode_utf8(v) for v in value]
+    return value
+
+def write_csv(records, f, fields=None):
+    '''
+    Write records to file object f as CSV (UTF-8) with a header row. By
+    default the fields are RECORD_FIELDS.
+    '''
+    if fields is None:
+        fields = RECORD_FIELDS
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    for record in records:
+        if 'longest_rhyme' in record:
+            record = dict(record)
+            (record['longest_rhyme_length'], record['longest_rhyme_wpos1'],
+             record['longest_rhyme_wpos2']) = record.pop('longest_rhyme')
+        row = []
+        for field in fields:
+            value = record.get(field)
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf8')
+            row.append(value)
+        writer.writerow(row)
+
+class SongResultStore:
+    '''
+    Persistent store (SQLite file) of the analysis results of songs (see
+    analyze_song). A result is reused as long as the content of the song
+    (and its transcription, or its preprocessed content in a pack, see
+    CorpusPack.content_hash) and the analysis parameters haven't changed.
+    '''
+
+    def __init__(self, path='results.sqlite'):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS results
+                (path TEXT, language TEXT, lookback INTEGER, variant TEXT,
+                 content_hash TEXT, result TEXT,
+                 PRIMARY KEY (path, language, lookback, variant))''')
+
+    @staticmethod
+    def content_hash(file_name, language):
+        '''
+        Hash of the song file and, for English, its stored transcription.
+        '''
+        h = hashlib.sha1()
+        fnames = [file_name]
+        if language != 'fi':
+            fnames.append(file_name + '.ipa')
+        for fname in fnames:
+            if os.path.exists(fname):
+                f = open(fname, 'rb')
+                h.update(f.read())
+                f.close()
+            h.update('\0')
+        return h.hexdigest()
+
+    def get_results(self, hashes, language, lookback, variant=''):
+        '''
+        Return a dict with the stored results of the songs (given as a dict
+        from file names to their content hashes) which are up to date.
+        '''
+        rows = self.conn.execute(
+                '''SELECT path, content_hash, result FROM results
+                WHERE language=? AND lookback=? AND variant=?''',
+                (language, lookback, variant))
+        results = {}
+        for path, content_hash, result in rows:
+            if hashes.get(path) == content_hash:
+                res = json.loads(result)
+                res['longest_rhyme'] = tuple(res['longest_rhyme'])
+                res['longest_rhyme_str'] = tuple(res['longest_rhyme_str'])
+                results[path] = res
+        return results
+
+    def put(self, file_name, content_hash, language, lookback, variant,
+            result):
+        with self.conn:
+            self.conn.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                    (file_name, language, lookback, variant, content_hash,
+                     json.dumps(result)))
+
+    def prune(self, prefix, file_names):
+        '''
+        Remove the results of the songs under directory prefix which are not
+        in file_names.
+        '''
+        prefix = os.path.join(prefix, '')
+        file_names = set(file_names)
+        paths = [path for (path,) in
+                 self.conn.execute('SELECT DISTINCT path FROM results')
+                 if path.startswith(prefix) and path not in file_names]
+        with self.conn:
+            self.conn.executemany('DELETE FROM results WHERE path=?',
+                                  [(path,) for path in paths])
+
+    def close(self):
+        self.conn.close()
+
+def list_songs(lyrics_dir, artist=None, album=None):
+    '''
+    List the song files to be analyzed.
+
+    Output:
+        List of (artist, albums) tuples where albums is a list of
+        (album, song file names) tuples sorted by the album year.
     '''
     if artist is not None:
         artists = [artist]
     else:
-        artists = os.listdir(lyrics_dir)
-    artist_scores = []
-    song_scores = []
-    song_names = []
-    uniq_words = []
-    longest_rhymes = []
-    max_rhymes = 5
+        artists = [name for name, is_dir in corpus_loader.list_dir(lyrics_dir)
+                   if is_dir]
+    song_lists = []
     for a in artists:
-        print "Analyzing artist: %s" % a
-        rls = []
-        all_words = []
         if album is not None:
             albums = [album]
         else:
-            albums = os.listdir(os.path.join(lyrics_dir, a))
+            albums = [name for name, is_dir in
+                      corpus_loader.list_dir(os.path.join(lyrics_dir, a))
+                      if is_dir]
             albums = sort_albums_by_year(albums)
+        album_songs = []
         for al in albums:
-            album_rls = []
-            songs = os.listdir(os.path.join(lyrics_dir, a, al))
+            songs = corpus_loader.list_dir(os.path.join(lyrics_dir, a, al))
             # Only the .txt files
-            songs = [s for s in songs if len(s)>=4 and s[-4:]=='.txt']
-            for song in songs:
-                file_name = os.path.join(lyrics_dir, a, al, song)
-                l = Lyrics(file_name, print_stats=print_stats, 
-                           language=language, lookback=lookback)
-                rl = l.get_avg_rhyme_length()
-                rls.append(rl)
-                song_scores.append(rl)
-                song_names.append(file_name)
-                album_rls.append(rl)
-                if len(longest_rhymes) < max_rhymes:
-                    heapq.heappush(longest_rhymes, l.get_longest_rhyme())
-                else:
-                    heapq.heappushpop(longest_rhymes, l.get_longest_rhyme())
+            songs = [s for s, is_dir in songs
+                     if not is_dir and len(s)>=4 and s[-4:]=='.txt']
+            album_songs.append(
+                    (al, [os.path.join(lyrics_dir, a, al, s) for s in songs]))
+        song_lists.append((a, album_songs))
+    return song_lists
 
-                if language == 'fi':
-                    all_words += l.text.split()
-                else:
-                    text = l.text_orig.lower()
-                    rx = re.compile(u'[^\wåäö]+')
-                    text = rx.sub(' ', text)
-                    all_words += text.split()
-            # Print stats for the album
-            #print "%s - %s: %.3f" % (a, al, np.mean(np.array(album_rls)))
-            #print "%.5f" % (np.mean(np.array(album_rls)))
-
-        # Compute the number of unique words the artist has used
-        n_words = len(all_words)
-        min_w = 20000
-        if n_words >= min_w:
-            n_uniq_words = len(set(all_words[:min_w]))
-            uniq_words.append(n_uniq_words)
+def _song_lists(lyrics_dir, artist, album, language, pack=None):
+    # The songs of the pack if it's given, otherwise list_songs
+    if pack is not None:
+        corpus = CorpusPack(pack)
+        if corpus.language != language:
+            raise Exception("The pack has been created for language %s" %
+                            corpus.language)
+        return corpus.list_songs(artist, album)
+    return list_songs(lyrics_dir, artist, album)
+
+def analyze_song(file_name, language, lookback, engine='loop',
+                 print_stats=False, profile=False, text=None,
+                 transcription=None, read_time=None, backend=None,
+                 cache=None, word_dict=None, pack=None):
+    '''
+    Analyze a single song. The results are returned as a small picklable
+    dict so that songs can be analyzed in worker processes.
+
+    Output:
+        Dict with keys:
+            avg_rhyme_length    Average rhyme length of the song.
+            longest_rhyme       Longest rhyme tuple (see Lyrics.rhyme_stats).
+            longest_rhyme_str   Tuple (rhyme length, rhyme string).
+            words               Word tokens used for the vocabulary size.
+            stats               Song summary printed with print_stats (None
+                                if print_stats is False).
+            profile             Profiling record of the song (see
+                                profiling.Profiler.song_record), only if
+                                profile is True.
+
+    If pack (CorpusPack) is given, the song is read from it. text and
+    transcription are the content of the song file and its .ipa file if
+    they have been read already (see corpus_loader.read_songs), and
+    read_time is the time spent reading them.
+    '''
+    if profile:
+        parent = profiling.active
+        profiling.active = profiling.Profiler()
+        if read_time is not None:
+            profiling.active.add_time('read', read_time)
+    try:
+        if pack is not None:
+            with profiling.stage('read'):
+                l = pack.get_lyrics(file_name, lookback=lookback,
+                                    engine=engine)
+        else:
+            l = Lyrics(file_name, text=text, language=language,
+                       lookback=lookback, engine=engine, backend=backend,
+                       cache=cache, word_dict=word_dict,
+                       transcription=transcription)
+        # The stages are timed separately from get_rhyme_str
+        l.analyze()
+        with profiling.stage('get_rhyme_str'):
+            longest_rhyme_str = l.get_longest_rhyme()
+        res = {
+                'avg_rhyme_length': l.get_avg_rhyme_length(),
+                'longest_rhyme': l.longest_rhyme,
+                'longest_rhyme_str': longest_rhyme_str,
+                'words': l.get_words()[:VOCABULARY_WORDS],
+                'stats': l.get_song_stats() if print_stats else None,
+                }
+        if profile:
+            res['profile'] = profiling.active.song_record(file_name)
+    finally:
+        if profile:
+            profiling.active = parent
+    return res
+
+def sweep_song(file_name, language, max_lookback, backend=None, cache=None,
+               word_dict=None, pack=None):
+    '''
+    Analyze a single song with every lookback 1..max_lookback.
+
+    Output:
+        Dict with keys avg_rhyme_lengths, longest_rhymes and
+        longest_rhyme_strs, which are lists of the corresponding values of
+        analyze_song for each lookback.
+    '''
+    l = _get_lyrics(file_name, language, max_lookback, backend, cache,
+                    word_dict, pack)
+    stats = l.rhyme_stats_sweep(max_lookback)
+    # The longest rhyme usually changes only a few times as the lookback
+    # grows, so the rhyme strings are constructed once per distinct rhyme
+    rhyme_strs = {}
+    longest_rhyme_strs = []
+    for avg_rl, longest_rhyme in stats:
+        if longest_rhyme not in rhyme_strs:
+            l.longest_rhyme = longest_rhyme
+            rhyme_strs[longest_rhyme] = l.get_longest_rhyme()
+        longest_rhyme_strs.append(rhyme_strs[longest_rhyme])
+    return {
+            'avg_rhyme_lengths': [avg_rl for avg_rl, lr in stats],
+            'longest_rhymes': [lr for avg_rl, lr in stats],
+            'longest_rhyme_strs': longest_rhyme_strs,
+            }
+
+def analyze_text(item_id, text, language, artist, lookback, engine='loop',
+                 backend=None, cache=None, word_dict=None):
+    '''
+    Analyze lyrics given as text. Returns a record of analyze_texts with
+    the word tokens of the lyrics under the key 'words'.
+    '''
+    l = Lyrics(text=text, language=language, lookback=lookback,
+               engine=engine, backend=backend, cache=cache,
+               word_dict=word_dict)
+    words = l.get_words()
+    return {
+            'id': item_id,
+            'artist': artist,
+            'language': language,
+            'lookback': lookback,
+            'avg_rhyme_length': float(l.get_avg_rhyme_length()),
+            'longest_rhyme': l.longest_rhyme,
+            'longest_rhyme_str': l.get_rhyme_str(l.longest_rhyme),
+            'n_words': len(words),
+            'words': words[:VOCABULARY_WORDS],
+            }
+
+def _get_lyrics(file_name, language, lookback=None, backend=None,
+                cache=None, word_dict=None, pack=None):
+    # The stages of the analysis are run only when their results are used
+    if lookback is None:
+        lookback = 10 if language == 'fi' else 15
+    if pack is not None:
+        return pack.get_lyrics(file_name, lookback=lookback)
+    return Lyrics(file_name, language=language, lookback=lookback,
+                  engine='numpy', backend=backend, cache=cache,
+                  word_dict=word_dict)
+
+def song_rhyme_pairs(file_name, language, lookback, min_length, k,
+                     all_pairs=True, backend=None, cache=None, word_dict=None,
+                     pack=None):
+    '''
+    Find the rhyme pairs of a single song (see Lyrics.rhyme_pairs).
+
+    Output:
+        Dict with keys n_pairs (number of pairs), top (array of the k longest
+        pairs as (wpos1, wpos2, length) rows, longest first) and pairs (all
+        pairs, or None if all_pairs is False).
+    '''
+    l = _get_lyrics(file_name, language, lookback, backend, cache, word_dict,
+                    pack)
+    pairs = l.rhyme_pairs(min_length)
+    # Longest first, ties in the order of the words
+    order = np.lexsort((pairs[:,0], pairs[:,1], -pairs[:,2]))
+    return {
+            'n_pairs': len(pairs),
+            'top': pairs[order[:k]],
+            'pairs': pairs if all_pairs else None,
+            }
+
+def render_rhymes(file_name, language, rhymes, backend=None, cache=None,
+                  word_dict=None, pack=None):
+    '''
+    Construct the strings (see Lyrics.get_rhyme_str) of the given
+    (wpos1, wpos2, length) rhymes of a song.
+    '''
+    l = _get_lyrics(file_name, language, None, backend, cache, word_dict,
+                    pack)
+    return [l.get_rhyme_str((length, wpos1, wpos2))
+            for wpos1, wpos2, length in rhymes]
+
+# eSpeak backend and transcription caches of the current (worker) process
+# passed to analyze_song
+_worker = {}
+
+def init_worker(espeak_procs, transcription_cache=None, word_phonemes=None,
+                pack=None):
+    _worker.clear()
+    if pack is not None:
+        _worker['pack'] = CorpusPack(pack)
+    if espeak_procs > 0:
+        _worker['backend'] = ph.EspeakPool(espeak_procs)
+    if transcription_cache is not None:
+        _worker['cache'] = ph.TranscriptionCache(transcription_cache)
+    if word_phonemes is not None:
+        _worker['word_dict'] = ph.WordPhonemeDict(word_phonemes)
+
+def close_worker():
+    for name, resource in _worker.items():
+        if name != 'pack':
+            resource.close()
+    _worker.clear()
+
+def start_workers(workers, espeak_procs, transcription_cache=None,
+                  word_phonemes=None, pack=None):
+    '''
+    Start a pool of worker processes if workers > 1. Otherwise the tasks are
+    run in this process, which is initialized as a worker. Returns the pool
+    (None without worker processes) to be given to map_tasks and
+    stop_workers.
+    '''
+    if workers > 1:
+        return multiprocessing.Pool(workers, init_worker,
+                                    (espeak_procs, transcription_cache,
+                                     word_phonemes, pack))
+    init_worker(espeak_procs, transcription_cache, word_phonemes, pack)
+    return None
+
+def map_tasks(pool, task_fn, tasks, window=None):
+    # imap returns the results in the order of the tasks
+    if pool is not None:
+        if window is not None:
+            return _windowed_imap(pool, task_fn, tasks, window)
+        return pool.imap(task_fn, tasks)
+    return itertools.imap(task_fn, tasks)
+
+def _windowed_imap(pool, task_fn, tasks, window):
+    # pool.imap takes the tasks as fast as it can, so let at most window
+    # tasks ahead of the results (e.g. to keep the read songs in memory only
+    # until they have been analyzed)
+    free = threading.Semaphore(window)
+    stopped = threading.Event()
+    def limited():
+        for task in tasks:
+            free.acquire()
+            if stopped.is_set():
+                return
+            yield task
+    try:
+        for res in pool.imap(task_fn, limited()):
+            free.release()
+            yield res
+    finally:
+        # Don't leave the task feeder of the pool waiting if the results
+        # are not consumed to the end
+        stopped.set()
+        free.release()
+
+def stop_workers(pool, terminate=False):
+    '''
+    Stop the workers started by start_workers. With terminate, the worker
+    processes are stopped without waiting for the remaining tasks.
+    '''
+    if pool is not None:
+        if terminate:
+            pool.terminate()
         else:
-            uniq_words.append(-n_words)
-        mean_rl = np.mean(np.array(rls))
-        artist_scores.append(mean_rl)
-
-    # Sort the artists based on their avg rhyme lengths
-    artist_scores = np.array(artist_scores)
-    artists = np.array(artists)
-    uniq_words = np.array(uniq_words)
-    order = np.argsort(artist_scores)[::-1]
-    artists = artists[order]
-    uniq_words = uniq_words[order]
-    artist_scores = artist_scores[order]
-
-    print "\nBest rhymes"
-    while len(longest_rhymes) > 0:
-        l, rhyme = heapq.heappop(longest_rhymes)
-        print rhyme
-
-    print "\nBest songs:"
-    song_scores = np.array(song_scores)
-    song_names = np.array(song_names)
-    song_names = song_names[np.argsort(song_scores)[::-1]]
-    song_scores = sorted(song_scores)[::-1]
-    for i in range(min(10,len(song_scores))):
-        print '%.3f\t%s' % (song_scores[i], song_names[i])
-
-    print "\nBest artists:"
-    for i in range(len(artist_scores)):
-        rx = re.compile(u'_')
-        name = rx.sub(' ', artists[i])
-        print '%d.\t%.3f\t%s' % (i+1, artist_scores[i], name)
+            pool.close()
+        pool.join()
+    else:
+        close_worker()
+
+def analyze_song_task(task):
+    return analyze_song(*task, **_worker)
+
+def sweep_song_task(task):
+    return sweep_song(*task, **_worker)
+
+def analyze_text_task(task):
+    return analyze_text(*task, **_worker)
+
+def song_rhyme_pairs_task(task):
+    return song_rhyme_pairs(*task, **_worker)
+
+def render_rhymes_task(task):
+    return render_rhymes(*task, **_worker)
+
+def import_transcriptions(transcription_cache, lyrics_dir='lyrics_en',
+                          language='en-us'):
+    '''
+    Import the existing <song>.txt.ipa transcriptions under lyrics_dir to a
+    phonetics.TranscriptionCache file. The transcriptions are stored under
+    the current text of each song, so only transcriptions which are known
+    to be up to date should be imported.
+    '''
+    cache = ph.TranscriptionCache(transcription_cache)
+    n_imported = 0
+    for a, albums in list_songs(lyrics_dir):
+        for al, songs in albums:
+            for file_name in songs:
+                if not os.path.exists(file_name + '.ipa'):
+                    continue
+                l = Lyrics(language=language)
+                f = codecs.open(file_name, 'r', 'utf8')
+                l.clean_text(f.read())
+                f.close()
+                cache.import_sidecar(l.text, language, file_name + '.ipa')
+                n_imported += 1
+    cache.close()
+    return n_imported
+
+def export_pack(pack_path, lyrics_dir='lyrics_en', artist=None, album=None,
+                language='en-us', transcription_cache=None):
+    '''
+    Preprocess the lyrics under lyrics_dir (as read_lyrics does) and store
+    them to a single pack file which can be given to read_lyrics.
+    '''
+    cache = None
+    if transcription_cache is not None:
+        cache = ph.TranscriptionCache(transcription_cache)
+    n_songs = write_pack(pack_path, list_songs(lyrics_dir, artist, album),
+                         language, cache=cache)
+    if cache is not None:
+        cache.close()
+    return n_songs
+
+def export_rhyme_index(index_dir, lyrics_dir='lyrics_en', artist=None,
+                       album=None, language='en-us', max_length=16,
+                       words=False, transcription_cache=None):
+    '''
+    Build a rhyme search index (see rhyme_index.RhymeIndex) of the lyrics
+    under lyrics_dir.
+    '''
+    cache = None
+    if transcription_cache is not None:
+        cache = ph.TranscriptionCache(transcription_cache)
+    n_entries = rhyme_index.write_index(
+            index_dir, list_songs(lyrics_dir, artist, album), language,
+            max_length, words, cache=cache)
+    if cache is not None:
+        cache.close()
+    return n_entries
+
+def compare_word_transcriptions(word_phonemes, lyrics_dir='lyrics_en',
+                                language='en-us', lookback=15,
+                                espeak_procs=0):
+    '''
+    Compare word-by-word transcriptions (phonetics.WordPhonemeDict) to the
+    whole-text transcriptions stored in the <song>.txt.ipa files.
+
+    Output:
+        Dict with the dictionary hit rate of word tokens, the number of
+        unique words sent to eSpeak, the fraction of songs and words whose
+        vowels differ (words are compared only in songs where both
+        transcriptions have the same number of words) and the mean absolute
+        difference of the average rhyme lengths.
+    '''
+    word_dict = ph.WordPhonemeDict(word_phonemes)
+    backend = None
+    if espeak_procs > 0:
+        backend = ph.EspeakPool(espeak_procs)
+    n_songs = n_songs_diff = n_words = n_words_diff = 0
+    rl_diffs = []
+    for a, albums in list_songs(lyrics_dir):
+        for al, songs in albums:
+            for file_name in songs:
+                if not os.path.exists(file_name + '.ipa'):
+                    continue
+                l1 = Lyrics(file_name, language=language, lookback=lookback)
+                l2 = Lyrics(file_name, language=language, lookback=lookback,
+                            backend=backend, word_dict=word_dict)
+                n_songs += 1
+                if l1.vow != l2.vow:
+                    n_songs_diff += 1
+                # Words can be compared only if eSpeak split them similarly
+                if len(l1.words) == len(l2.words):
+                    n_words += len(l1.words)
+                    n_words_diff += sum(w1 != w2 for w1, w2
+                                        in zip(l1.words, l2.words))
+                rl_diffs.append(abs(l1.avg_rhyme_length - l2.avg_rhyme_length))
+    n_tokens = word_dict.n_token_hits + word_dict.n_token_misses
+    report = {
+            'songs': n_songs,
+            'token_hit_rate': word_dict.n_token_hits / float(max(n_tokens, 1)),
+            'types_transcribed': word_dict.n_types_transcribed,
+            'songs_differing': n_songs_diff / float(max(n_songs, 1)),
+            'words_compared': n_words,
+            'words_differing': n_words_diff / float(max(n_words, 1)),
+            'mean_rhyme_length_diff': np.mean(rl_diffs) if n_songs > 0 else 0,
+            }
+    word_dict.close()
+    if backend is not None:
+        backend.close()
+    return report
 
 def sort_albums_by_year(albums):
     years = []
@@ -129,6 +1252,10 @@ def sort_albums_by_year(albums):
     return albums
 
 def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'merge':
+        # python raplyzer.py merge <shard file>...
+        merge_shards(sys.argv[2:])
+        return
     # Analyze lyrics of all available artists (English)
     read_lyrics(lyrics_dir='lyrics_en', language='en-us', lookback=15)
     # Analyze lyrics of Paleface (English)
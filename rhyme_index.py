@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import numpy as np
+
+from lyrics import Lyrics
+
+'''
+This file contains a search index for finding the lines of a whole corpus
+which rhyme longest with a given line or word.
+
+For every line end (or every word end) of the corpus, the index stores a
+key which is the reversed vowel sequence ending at the last vowel of the
+word, i.e. the last vowel first. The keys are sorted, so the keys sharing
+the longest common prefix with the key of a query, i.e. the longest rhymes,
+are next to the position of the query found by binary search.
+
+The index is stored as a directory of .npy files, which are memory-mapped
+when the index is loaded, and a JSON file with the other information:
+    meta.json       Language, key length, vowel alphabet and songs.
+    keys.npy        Sorted keys, uint8 array (entries x max_length). Vowels
+                    are coded by their position in the alphabet + 1 and
+                    keys shorter than max_length are padded with zeros.
+    song.npy        Song index of each entry.
+    line.npy        Line index of each entry (global over all songs).
+    word.npy        Word index of each entry within the song.
+    word_hash.npy   CRC32 of the last word of each entry.
+    line_starts.npy Offset of each line in lines.npy.
+    lines.npy       UTF-8 encoded lines of all songs.
+    song_lines.npy  Global line index of the first line of each song.
+'''
+
+ENTRY_ARRAYS = ['keys', 'song', 'line', 'word', 'word_hash']
+# Code for the vowels of a query which do not appear in the corpus
+UNKNOWN_VOWEL = 255
+
+def write_index(index_dir, song_lists, language, max_length=16, words=False,
+                **lyrics_args):
+    '''
+    Build a rhyme index of the songs and write it to index_dir.
+
+    Input:
+        index_dir   Directory where the index is written (created if it
+                    doesn't exist).
+        song_lists  Songs to be indexed (see raplyzer.list_songs).
+        language    Language of the lyrics.
+        max_length  Maximum rhyme length (in vowels) that is distinguished.
+        words       Index every word end instead of only the line ends.
+        lyrics_args Other arguments for Lyrics (e.g. the transcription
+                    cache).
+
+    Output:
+        Number of entries in the index.
+    '''
+    entries = dict((name, []) for name in ENTRY_ARRAYS)
+    songs = []
+    lines = []
+    song_lines = []
+    alphabet = {}
+    for a, albums in song_lists:
+        for al, file_names in albums:
+            for file_name in file_names:
+                l = Lyrics(file_name, language=language, **lyrics_args)
+                song_lines.append(len(lines))
+                song_entries = song_keys(l, max_length, words, alphabet)
+                song_entries['song'] = np.repeat(len(songs),
+                                                 len(song_entries['word']))
+                song_entries['line'] += len(lines)
+                for name in ENTRY_ARRAYS:
+                    entries[name].append(song_entries[name])
+                lines += song_lines_text(l)
+                songs.append({'artist': a, 'album': al,
+                              'filename': file_name})
+    if len(alphabet) >= UNKNOWN_VOWEL:
+        raise Exception("Too many different vowels: %d" % len(alphabet))
+
+    data = {}
+    data['keys'] = np.concatenate([np.zeros((0, max_length), np.uint8)] +
+                                  entries['keys'])
+    for name in ENTRY_ARRAYS[1:]:
+        data[name] = np.concatenate([np.zeros(0, np.int32)] +
+                                    entries[name]).astype(np.int32)
+    # Sort the entries lexicographically by their keys
+    order = np.lexsort(data['keys'].T[::-1])
+    for name in ENTRY_ARRAYS:
+        data[name] = data[name][order]
+    encoded = [line.encode('utf8') for line in lines]
+    data['lines'] = np.array(bytearray(''.join(encoded)), dtype=np.uint8)
+    data['line_starts'] = np.cumsum([0] + [len(line) for line in encoded],
+                                    dtype=np.int64)
+    data['song_lines'] = np.array(song_lines, dtype=np.int32)
+
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for name, array in data.items():
+        np.save(os.path.join(index_dir, name + '.npy'), array)
+    vowels = sorted(alphabet, key=alphabet.get)
+    meta = {'language': language, 'max_length': max_length, 'words': words,
+            'alphabet': vowels, 'songs': songs}
+    f = open(os.path.join(index_dir, 'meta.json'), 'w')
+    json.dump(meta, f)
+    f.close()
+    return len(data['word'])
+
+def song_keys(l, max_length, words=False, alphabet=None):
+    '''
+    Keys of the line ends (or word ends) of Lyrics l.
+
+    Input:
+        alphabet    Dict from vowels to their codes. New vowels are added to
+                    it if it's given. Otherwise unknown vowels are coded by
+                    UNKNOWN_VOWEL.
+
+    Output:
+        Dict with arrays 'keys' (entries x max_length), 'word' (word index),
+        'line' (line index within the song) and 'word_hash'.
+    '''
+    if alphabet is None:
+        vow = [UNKNOWN_VOWEL] * len(l.vow)
+    else:
+        vow = [alphabet.setdefault(c, len(alphabet)+1) for c in l.vow]
+    vow = np.array(vow, dtype=np.uint8)
+    lines = word_lines(l)
+    selected = np.arange(len(l.word_ends))
+    if not words and len(selected) > 0:
+        # The last word of each line
+        selected = selected[np.append(lines[1:] != lines[:-1], True)]
+    ends = np.array(l.word_ends, dtype=int)[selected]
+    offsets = ends[:,None] - np.arange(max_length)[None,:]
+    keys = np.where(offsets >= 0, vow[np.maximum(offsets, 0)], 0)
+    return {'keys': keys.astype(np.uint8),
+            'word': selected,
+            'line': lines[selected],
+            'word_hash': np.array([word_hash(l.words[w]) for w in selected],
+                                  dtype=np.int32)}
+
+def word_lines(l):
+    '''
+    Line index (in song_lines_text(l)) of each word of Lyrics l.
+    '''
+    idxs = np.array([l.vow_idxs[p] for p in l.word_ends], dtype=int)
+    return np.searchsorted(l.line_starts, idxs, side='right') - 1
+
+def song_lines_text(l):
+    '''
+    The line of the lyrics corresponding to each line of l.text.
+    '''
+    if l.language == 'fi':
+        return l.text.split('\n')
+    # eSpeak can split a line of the lyrics (e.g. at the end of a sentence),
+    # so the lines of the transcription correspond to the original lines
+    # only approximately (as in Lyrics.get_rhyme_str). There must be a line
+    # for each line of the transcription so that the lines of a song are
+    # not taken from the next song.
+    n_lines = len(l.line_starts)
+    return (list(l.lines_orig) + [u''] * n_lines)[:n_lines]
+
+def word_hash(word):
+    # Signed 32-bit so that it fits to int32 arrays
+    return zlib.crc32(word.encode('utf8'))
+
+class RhymeIndex:
+    '''
+    Read-only view to an index written by write_index. The arrays are
+    memory-mapped when the index is queried for the first time.
+    '''
+
+    def __init__(self, index_dir):
+        self.dir = index_dir
+        f = open(os.path.join(index_dir, 'meta.json'))
+        meta = json.load(f)
+        f.close()
+        self.language = meta['language']
+        self.max_length = meta['max_length']
+        self.songs = meta['songs']
+        self.alphabet = dict((c, i+1) for i, c in enumerate(meta['alphabet']))
+        self.arrays = None
+
+    def _load(self):
+        if self.arrays is None:
+            self.arrays = {}
+            for name in ENTRY_ARRAYS + ['lines', 'line_starts', 'song_lines']:
+                self.arrays[name] = np.load(
+                        os.path.join(self.dir, name + '.npy'), mmap_mode='r')
+            # Byte strings compare like the rows of uint8 keys
+            keys = self.arrays['keys']
+            self.sorted_keys = keys.view('S%d' % self.max_length).ravel()
+        return self.arrays
+
+    def __len__(self):
+        return len(self._load()['word'])
+
+    def query(self, text, k=10, min_length=2, **lyrics_args):
+        '''
+        Find the lines which rhyme longest with the last word of text.
+
+        Input:
+            text        Query line or word (cleaned and transcribed like
+                        the lyrics of the corpus).
+            k           Maximum number of results.
+            min_length  Minimum rhyme length (rhymes of length 1 are ignored
+                        also in the rhyme stats of Lyrics).
+            lyrics_args Other arguments for Lyrics (e.g. the transcription
+                        cache for English).
+
+        Output:
+            List of dicts with keys length, artist, album, song (file name),
+            line (line index within the song), text (the line) and word
+            (word index within the song), longest rhyme first. Rhymes longer
+            than max_length vowels have length max_length.
+        '''
+        l = Lyrics(text=text, language=self.language, **lyrics_args)
+        if len(l.word_ends) == 0:
+            return []
+        p = l.word_ends[-1]
+        key = []
+        for i in range(p, max(p-self.max_length, -1), -1):
+            key.append(self.alphabet.get(l.vow[i], UNKNOWN_VOWEL))
+        key = np.array(key + [0] * (self.max_length - len(key)),
+                       dtype=np.uint8)
+        results = self.search(key, word_hash(l.words[-1]), k, min_length)
+        return [self._result(i, length) for i, length in results]
+
+    def search(self, key, query_hash=None, k=10, min_length=2):
+        '''
+        Find the entries whose keys have the longest common prefixes with
+        key (uint8 array of length max_length). Entries whose last word has
+        the hash query_hash are skipped since a word does not rhyme with
+        itself.
+
+        Output:
+            List of (entry index, rhyme length) tuples.
+        '''
+        a = self._load()
+        keys = a['keys']
+        n = len(keys)
+        key_len = int(np.sum(np.cumprod(key != 0)))
+        pos = int(np.searchsorted(self.sorted_keys, key.tostring()))
+        # The common prefix length decreases when moving away from pos, so
+        # grow a window around pos until it's known to contain the top k
+        width = 4 * k
+        while True:
+            start = max(pos - width, 0)
+            end = min(pos + width, n)
+            window = np.asarray(keys[start:end])
+            same = np.cumprod(window[:,:key_len] == key[:key_len], axis=1)
+            lengths = same.sum(axis=1)
+            ok = lengths >= min_length
+            if query_hash is not None:
+                ok &= np.asarray(a['word_hash'][start:end]) != query_hash
+            idxs = np.nonzero(ok)[0]
+            # Longest first, ties in the order of the index
+            idxs = idxs[np.argsort(-lengths[idxs], kind='mergesort')][:k]
+            # The longest rhyme outside the window
+            outside = 0
+            if start > 0:
+                outside = max(outside, lengths[0])
+            if end < n:
+                outside = max(outside, lengths[-1])
+            if (start == 0 and end == n) or outside < min_length or \
+                    (len(idxs) == k and lengths[idxs[-1]] > outside):
+                break
+            width *= 4
+        return [(start + i, int(lengths[i])) for i in idxs]
+
+    def _result(self, i, length):
+        a = self.arrays
+        song = int(a['song'][i])
+        line = int(a['line'][i])
+        line_text = a['lines'][a['line_starts'][line]:a['line_starts'][line+1]]
+        return {'length': length,
+                'artist': self.songs[song]['artist'],
+                'album': self.songs[song]['album'],
+                'song': self.songs[song]['filename'],
+                'line': line - int(a['song_lines'][song]),
+                'word': int(a['word'][i]),
+                'text': line_text.tostring().decode('utf8')}
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+'''
+A long-running scoring daemon which keeps the analysis modules loaded, the
+eSpeak processes running and the transcriptions and results in memory, so
+that scoring a single verse doesn't pay the start-up cost of Python, NumPy
+and eSpeak.
+
+The daemon listens to a Unix socket and serves each client connection in a
+thread of its own. The protocol is JSON lines: each request line is an
+object with keys text, language (default fi), lookback (default 10 for
+Finnish and 15 for English) and optionally id, and the daemon answers each
+request with a line containing the record of raplyzer.analyze_texts
+(id, language, lookback, avg_rhyme_length, longest_rhyme,
+longest_rhyme_str and n_words) or an object with key error. Texts longer
+than --max-text-length characters and requests not scored within --timeout
+seconds are answered with an error.
+
+Usage:
+    python scoring_server.py serve --socket /tmp/raplyzer.sock \\
+        --espeak-procs 2 --transcription-cache transcriptions.sqlite
+    python scoring_server.py score --socket /tmp/raplyzer.sock -l fi < verse.txt
+    python scoring_server.py score --cold -l fi < verse.txt
+
+(--cold analyzes the text in the client process without the daemon.)
+'''
+
+import argparse
+import codecs
+import collections
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+
+DEFAULT_SOCKET = '/tmp/raplyzer.sock'
+MAX_TEXT_LENGTH = 100000
+TIMEOUT = 60
+
+def score_text(text, language='fi', lookback=None, backend=None, cache=None):
+    '''
+    Score a single text (see raplyzer.analyze_text). The default lookback is
+    10 for Finnish and 15 for English.
+    '''
+    # Imported here so that the client doesn't need to load NumPy
+    import raplyzer
+    if lookback is None:
+        lookback = 10 if language == 'fi' else 15
+    record = raplyzer.analyze_text(None, text, language, None, lookback,
+                                   engine='numpy', backend=backend,
+                                   cache=cache)
+    del record['artist']
+    del record['words']
+    return record
+
+class ScoringServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    '''
+    The scoring daemon. The results of at most max_results distinct requests
+    are kept in memory (least recently used are evicted). If
+    transcription_cache is given, the transcriptions are also stored to
+    that phonetics.TranscriptionCache file.
+
+    Texts longer than max_text_length characters are refused and a request
+    which isn't scored in timeout seconds fails (the scoring of the text
+    continues in the background, e.g. until eSpeak finishes).
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, espeak_procs=1,
+                 transcription_cache=None, max_transcriptions=10000,
+                 max_results=10000, max_text_length=MAX_TEXT_LENGTH,
+                 timeout=TIMEOUT):
+        import phonetics as ph
+        # Load the analysis modules before serving the first request
+        import raplyzer
+        self.backend = None
+        if espeak_procs > 0:
+            self.backend = ph.EspeakPool(espeak_procs)
+        store = None
+        if transcription_cache is not None:
+            store = ph.TranscriptionCache(transcription_cache,
+                                          check_same_thread=False)
+        self.cache = ph.MemoryTranscriptionCache(max_transcriptions, store)
+        self.max_results = max_results
+        self.max_text_length = max_text_length
+        self.timeout = timeout
+        self.results = collections.OrderedDict()
+        self.results_lock = threading.Lock()
+        # A stale socket file of a previous daemon would prevent binding
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               ScoringHandler)
+
+    def score(self, request):
+        if not isinstance(request, dict):
+            raise Exception("The request must be a JSON object")
+        text = request.get('text')
+        language = request.get('language', 'fi')
+        lookback = request.get('lookback')
+        if not isinstance(text, basestring):
+            raise Exception("The request must have a string text")
+        if not isinstance(language, basestring):
+            raise Exception("The language must be a string")
+        if lookback is not None and (not isinstance(lookback, (int, long))
+                                     or isinstance(lookback, bool)
+                                     or lookback < 1):
+            raise Exception("The lookback must be a positive integer")
+        if len(text) > self.max_text_length:
+            raise Exception("The text is longer than %d characters" %
+                            self.max_text_length)
+        key = (text, language, lookback)
+        with self.results_lock:
+            record = self.results.pop(key, None)
+            if record is not None:
+                self.results[key] = record
+        if record is None:
+            record = self._score_text(text, language, lookback)
+            with self.results_lock:
+                self.results[key] = record
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+        record = dict(record)
+        record['id'] = request.get('id')
+        return record
+
+    def _score_text(self, text, language, lookback):
+        # Scored in another thread so that a stuck backend doesn't block
+        # the client's connection
+        result = []
+        def run():
+            try:
+                result.append((score_text(text, language, lookback,
+                                          self.backend, self.cache), None))
+            except Exception as e:
+                result.append((None, e))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+        if len(result) == 0:
+            raise Exception("Scoring timed out after %s seconds" %
+                            self.timeout)
+        record, error = result[0]
+        if error is not None:
+            raise error
+        return record
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        if self.backend is not None:
+            self.backend.close()
+        self.cache.close()
+
+class ScoringHandler(SocketServer.StreamRequestHandler):
+    '''
+    Serves the requests of one client connection (one JSON object per line)
+    until the client closes the connection.
+    '''
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if len(line.strip()) == 0:
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                response = self.server.score(request)
+            except Exception as e:
+                request_id = None
+                if isinstance(request, dict):
+                    request_id = request.get('id')
+                response = {'id': request_id, 'error': str(e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False
+                                        ).encode('utf8') + '\n')
+            self.wfile.flush()
+
+class ScoringClient:
+    '''
+    Client of the scoring daemon. The connection is kept open between the
+    requests.
+    '''
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.f = self.sock.makefile('rb')
+
+    def score(self, text, language='fi', lookback=None, request_id=None):
+        request = {'text': text, 'language': language, 'lookback': lookback,
+                   'id': request_id}
+        self.sock.sendall(json.dumps(request).encode('utf8') + '\n')
+        line = self.f.readline()
+        if len(line) == 0:
+            raise Exception("The scoring daemon closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise Exception("Scoring failed: %s" % response['error'])
+        return response
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'score'])
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--espeak-procs', type=int, default=1,
+                        help='Number of eSpeak processes of the daemon.')
+    parser.add_argument('--transcription-cache',
+                        help='phonetics.TranscriptionCache file used by the '
+                        'daemon.')
+    parser.add_argument('--max-text-length', type=int,
+                        default=MAX_TEXT_LENGTH,
+                        help='Longest text (in characters) scored by the '
+                        'daemon.')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='Seconds after which the daemon fails a '
+                        'request.')
+    parser.add_argument('-l', '--language', default='fi')
+    parser.add_argument('--lookback', type=int)
+    parser.add_argument('--cold', action='store_true',
+                        help='Score without the daemon.')
+    parser.add_argument('file', nargs='?',
+                        help='Text file to be scored (default: stdin).')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = ScoringServer(args.socket, args.espeak_procs,
+                               args.transcription_cache,
+                               max_text_length=args.max_text_length,
+                               timeout=args.timeout)
+        # Clean up (remove the socket, stop eSpeak) also when terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+    if args.file is not None:
+        f = codecs.open(args.file, 'r', 'utf8')
+        text = f.read()
+        f.close()
+    else:
+        text = sys.stdin.read().decode('utf8')
+    if args.cold:
+        record = score_text(text, args.language, args.lookback)
+    else:
+        client = ScoringClient(args.socket)
+        record = client.score(text, args.language, args.lookback)
+        client.close()
+    print json.dumps(record, ensure_ascii=False).encode('utf8')
+
+if __name__ == '__main__':
+    main()
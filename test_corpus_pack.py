@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the corpus pack. The songs read from a pack must give the same
+results as the songs read from the lyrics files.
+
+Usage:
+    python -m unittest test_corpus_pack
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import corpus_pack
+import raplyzer
+from lyrics import Lyrics
+from test_raplyzer import run_quietly
+
+CORPORA = [('lyrics', 'fi', 10), ('lyrics_en', 'en-us', 15)]
+
+def utf8_listing(song_lists):
+    # The names listed from a pack are unicode, the others byte strings
+    return [(raplyzer._utf8(a),
+             [(raplyzer._utf8(al), [raplyzer._utf8(f) for f in songs])
+              for al, songs in albums])
+            for a, albums in song_lists]
+
+class CorpusPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        for lyrics_dir, language, lookback in CORPORA:
+            pack_fname = os.path.join(self.tmp_dir, language + '.pack')
+            song_lists = raplyzer.list_songs(lyrics_dir)
+            n_songs = corpus_pack.write_pack(pack_fname, song_lists, language)
+            pack = corpus_pack.CorpusPack(pack_fname)
+            self.assertEqual(len(pack), n_songs)
+            self.assertEqual(pack.language, language)
+            self.assertEqual(utf8_listing(pack.list_songs()),
+                             utf8_listing(song_lists))
+            for i, s in enumerate(pack.songs):
+                expected = Lyrics(s['filename'], language=language,
+                                  lookback=lookback)
+                for key in [i, s['filename']]:
+                    l = pack.get_lyrics(key, lookback=lookback)
+                    self.assertEqual(l.text, expected.text)
+                    self.assertEqual(l.rhyme_stats(), expected.rhyme_stats())
+                    self.assertEqual(l.get_longest_rhyme(),
+                                     expected.get_longest_rhyme())
+                    self.assertEqual(len(l.get_words()),
+                                     len(expected.get_words()))
+
+    def test_content_hash(self):
+        lyrics_dir = os.path.join(self.tmp_dir, 'lyrics')
+        album_dir = os.path.join(lyrics_dir, 'artist', 'album')
+        os.makedirs(album_dir)
+        fnames = [os.path.join(album_dir, 'song%d.txt' % i) for i in range(3)]
+        for i, fname in enumerate(fnames):
+            f = open(fname, 'w')
+            f.write('talo %d palo\nkala sala\n' % i)
+            f.close()
+        pack_fname = os.path.join(self.tmp_dir, 'fi.pack')
+
+        def hashes():
+            corpus_pack.write_pack(pack_fname,
+                                   raplyzer.list_songs(lyrics_dir), 'fi')
+            pack = corpus_pack.CorpusPack(pack_fname)
+            return [pack.content_hash(fname) for fname in fnames]
+
+        before = hashes()
+        self.assertEqual(len(set(before)), len(fnames))
+        self.assertEqual(hashes(), before)
+        f = open(fnames[1], 'w')
+        f.write('talo 1 palo\nkala sala\nmaa taa\n')
+        f.close()
+        after = hashes()
+        self.assertEqual([h1 == h2 for h1, h2 in zip(before, after)],
+                         [True, False, True])
+
+    def test_read_lyrics(self):
+        for lyrics_dir, language, lookback in CORPORA:
+            pack_fname = os.path.join(self.tmp_dir, language + '.pack')
+            raplyzer.export_pack(pack_fname, lyrics_dir, language=language)
+            expected = run_quietly(raplyzer.read_lyrics, lyrics_dir,
+                                   language=language, lookback=lookback)
+            output = run_quietly(raplyzer.read_lyrics, lyrics_dir,
+                                 language=language, lookback=lookback,
+                                 pack=pack_fname)
+            self.assertEqual(output, expected)
+
+if __name__ == '__main__':
+    unittest.main()
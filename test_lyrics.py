@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of Lyrics. The numpy rhyme engine, the lookback sweep and appending
+lines must give the same results as the original loop over the whole song.
+
+Usage:
+    python -m unittest test_lyrics
+'''
+
+import codecs
+import glob
+import random
+import sys
+import unittest
+
+from lyrics import Lyrics
+import phonetics as ph
+
+LOOKBACKS = [1, 3, 10, 15, 30]
+
+def bundled_songs():
+    '''
+    Output:
+        List of (file name, language) tuples of the songs in the repository.
+    '''
+    return [(f, 'fi') for f in sorted(glob.glob('lyrics/*/*/*.txt'))] + \
+           [(f, 'en-us') for f in sorted(glob.glob('lyrics_en/*/*/*.txt'))]
+
+def random_texts(n_texts, seed=0):
+    '''
+    Random Finnish-like texts with short words so that there are rhymes of
+    various lengths.
+    '''
+    rng = random.Random(seed)
+    syllables = [u'ka', u'ta', u'lo', u'mi', u'sy', u'ää', u'ri', u'nen',
+                 u'ki', u'vö', u'ou', u'ie', u'an']
+    texts = []
+    for i in range(n_texts):
+        lines = []
+        for j in range(rng.randint(0, 12)):
+            words = [u''.join(rng.choice(syllables)
+                              for s in range(rng.randint(1, 4)))
+                     for w in range(rng.randint(0, 7))]
+            lines.append(u' '.join(words))
+        texts.append(u'\n'.join(lines))
+    return texts
+
+class EngineParityTest(unittest.TestCase):
+
+    def assertSameStats(self, stats, expected, msg):
+        self.assertAlmostEqual(stats[0], expected[0], places=12, msg=msg)
+        self.assertEqual(stats[1], expected[1], msg)
+
+    def test_bundled_songs(self):
+        for f, language in bundled_songs():
+            for lookback in LOOKBACKS:
+                l = Lyrics(f, language=language, lookback=lookback)
+                n = Lyrics(f, language=language, lookback=lookback,
+                           engine='numpy')
+                self.assertSameStats(n.rhyme_stats(), l.rhyme_stats(),
+                                     '%s lookback %d' % (f, lookback))
+
+    def test_random_texts(self):
+        for i, text in enumerate(random_texts(100)):
+            for lookback in LOOKBACKS:
+                l = Lyrics(text=text, language='fi', lookback=lookback)
+                n = Lyrics(text=text, language='fi', lookback=lookback,
+                           engine='numpy')
+                self.assertSameStats(n.rhyme_stats(), l.rhyme_stats(),
+                                     'text %d lookback %d' % (i, lookback))
+
+class SweepTest(unittest.TestCase):
+
+    def test_sweep(self):
+        max_lookback = max(LOOKBACKS)
+        songs = [(Lyrics(f, language=language), f)
+                 for f, language in bundled_songs()]
+        songs += [(Lyrics(text=text, language='fi'), 'text %d' % i)
+                  for i, text in enumerate(random_texts(50, seed=1))]
+        for l, name in songs:
+            sweep = l.rhyme_stats_sweep(max_lookback)
+            self.assertEqual(len(sweep), max_lookback)
+            for lookback in LOOKBACKS:
+                l.lookback = lookback
+                expected = l.rhyme_stats()
+                self.assertAlmostEqual(sweep[lookback-1][0], expected[0],
+                                       places=12)
+                self.assertEqual(sweep[lookback-1][1], expected[1],
+                                 '%s lookback %d' % (name, lookback))
+
+class AppendLineTest(unittest.TestCase):
+
+    def assertSameLyrics(self, appended, batch, name):
+        self.assertAlmostEqual(appended.avg_rhyme_length,
+                               batch.avg_rhyme_length, places=12, msg=name)
+        self.assertEqual(appended.longest_rhyme, batch.longest_rhyme, name)
+        self.assertEqual(appended.get_longest_rhyme(),
+                         batch.get_longest_rhyme(), name)
+
+    def test_append_line(self):
+        texts = []
+        for f in sorted(glob.glob('lyrics/*/*/*.txt')):
+            fi = codecs.open(f, 'r', 'utf8')
+            texts.append((f, fi.read()))
+            fi.close()
+        texts += [('text %d' % i, text)
+                  for i, text in enumerate(random_texts(50, seed=2))]
+        for name, text in texts:
+            batch = Lyrics(text=text, language='fi', lookback=10)
+            appended = Lyrics(language='fi', lookback=10)
+            for line in text.split('\n'):
+                appended.append_line(line)
+            self.assertSameLyrics(appended, batch, name)
+
+    def test_append_to_text(self):
+        for i, text in enumerate(random_texts(30, seed=4)):
+            lines = text.split('\n')
+            batch = Lyrics(text=text, language='fi', lookback=10)
+            appended = Lyrics(text=u'\n'.join(lines[:3]), language='fi',
+                              lookback=10)
+            for line in lines[3:]:
+                appended.append_line(line)
+            self.assertSameLyrics(appended, batch, 'text %d' % i)
+
+    def test_append_line_english(self):
+        # The fake eSpeak transcribes each line separately, like appending
+        pool = ph.EspeakPool(command=[sys.executable, 'fake_espeak.py'])
+        try:
+            for f in sorted(glob.glob('lyrics_en/*/*/*.txt'))[:5]:
+                fi = codecs.open(f, 'r', 'utf8')
+                text = fi.read()
+                fi.close()
+                batch = Lyrics(text=text, language='en-us', lookback=15,
+                               backend=pool)
+                appended = Lyrics(language='en-us', lookback=15,
+                                  backend=pool)
+                for line in text.split('\n'):
+                    appended.append_line(line)
+                self.assertSameLyrics(appended, batch, f)
+        finally:
+            pool.close()
+
+class LazyStagesTest(unittest.TestCase):
+
+    def test_unknown_language(self):
+        self.assertRaisesRegexp(Exception, 'Unknown language', Lyrics,
+                                text=u'talo palo', language='sv')
+
+    def test_stages_run_on_access(self):
+        for text in random_texts(20, seed=3):
+            eager = Lyrics(text=text, language='fi', print_stats=False,
+                           lean=True)
+            lazy = Lyrics(text=text, language='fi')
+            self.assertEqual(lazy.get_words(), eager.get_words())
+            self.assertEqual(lazy.longest_rhyme, eager.longest_rhyme)
+            self.assertAlmostEqual(lazy.avg_rhyme_length,
+                                   eager.avg_rhyme_length, places=12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the transcription backends. eSpeak is replaced by fake_espeak.py,
+so the tests don't need eSpeak.
+
+Usage:
+    python -m unittest test_phonetics
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import fake_espeak
+import phonetics as ph
+import profiling
+import raplyzer
+from lyrics import Lyrics
+
+FAKE_ESPEAK = [sys.executable, 'fake_espeak.py']
+
+def fake_transcription(text):
+    '''
+    The output of fake_espeak.py for text.
+    '''
+    return u''.join(fake_espeak.transcribe_line(l) + u'\n'
+                    for l in text.split(u'\n') if len(l.strip()) > 0)
+
+def random_text(n_words, seed=0):
+    rng = random.Random(seed)
+    words = [u'talo', u'hello', u'night', u'räppi', u'flow', u'beat',
+             u'kaupunki', u'rhyme']
+    lines = []
+    while n_words > 0:
+        n = min(rng.randint(1, 10), n_words)
+        lines.append(u' '.join(rng.choice(words) for i in range(n)) + u'.')
+        n_words -= n
+    return u'\n'.join(lines)
+
+class EspeakPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ph.EspeakPool(2, command=FAKE_ESPEAK)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_transcribe(self):
+        for text in [u'hello there.\n', u'one\ntwo', u'', u'\n\n']:
+            self.assertEqual(self.pool.transcribe(text),
+                             fake_transcription(text))
+
+    def test_large_text(self):
+        # Larger than the pipe buffers
+        text = random_text(30000)
+        self.assertEqual(self.pool.transcribe(text),
+                         fake_transcription(text))
+        self.assertEqual(self.pool.transcribe(u'after.'),
+                         fake_transcription(u'after.'))
+
+    def test_sentinel_in_text(self):
+        # The sentinel of the earlier versions
+        text = u'zyxxyz.\nafter.\n'
+        self.assertEqual(self.pool.transcribe(text), fake_transcription(text))
+        self.assertEqual(self.pool.transcribe(u'next.'),
+                         fake_transcription(u'next.'))
+
+class RunEspeakTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_espeak(self):
+        text = u'hello there.\nmy friend.\n'
+        self.assertEqual(ph.run_espeak(text, command=FAKE_ESPEAK),
+                         fake_transcription(text))
+
+    def test_failure_raises(self):
+        failing = [sys.executable, '-c', 'import sys; sys.exit(3)']
+        self.assertRaises(Exception, ph.run_espeak, u'hello.', 'en-us',
+                          failing)
+
+    def test_failure_is_not_stored(self):
+        cache = ph.TranscriptionCache(os.path.join(self.tmp_dir,
+                                                   'cache.sqlite'))
+        ipa_fname = os.path.join(self.tmp_dir, 'song.txt.ipa')
+        path = os.environ['PATH']
+        # No eSpeak on the path
+        os.environ['PATH'] = self.tmp_dir
+        try:
+            self.assertRaises(Exception, ph.get_phonetic_transcription,
+                              u'hello.', cache=cache)
+            self.assertRaises(Exception, ph.get_phonetic_transcription,
+                              u'hello.', output_fname=ipa_fname)
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(cache.get(u'hello.', 'en-us'), None)
+        self.assertFalse(os.path.exists(ipa_fname))
+        cache.close()
+
+class SentenceBackend:
+    '''
+    Transcribes like fake_espeak.py but, like eSpeak, outputs a line for
+    each sentence and joins the line after "mr." to it.
+    '''
+
+    def transcribe(self, text, language='en-us'):
+        lines = []
+        for line in text.split(u'\n'):
+            if len(lines) > 0 and lines[-1].endswith(u'mr.'):
+                lines[-1] += u' ' + line
+            else:
+                lines.append(line)
+        text = u'\n'.join(lines)
+        for c in u'?!':
+            text = text.replace(c, c + u'\n')
+        return fake_transcription(text)
+
+class WordPhonemeDictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.word_dict = ph.WordPhonemeDict(os.path.join(self.tmp_dir,
+                                                         'words.sqlite'))
+
+    def tearDown(self):
+        self.word_dict.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def assertWordsAligned(self, words, backend):
+        # The same as transcribing each word alone
+        stored = ph.WordPhonemeDict(self.word_dict.path)
+        try:
+            for w in words:
+                expected = u' '.join(backend.transcribe(w + u'.\n').split())
+                self.assertEqual(self.word_dict.words['en-us'][w], expected, w)
+                self.assertEqual(stored._load('en-us')[w], expected, w)
+        finally:
+            stored.close()
+
+    def test_add_words(self):
+        # Words with several sentences or without letters
+        words = [u'hello', u'e.g', u'what?is', u'wow!now', u'---', u'42',
+                 u'zixxiz', u'zyxxyz', u'night']
+        pool = ph.EspeakPool(command=FAKE_ESPEAK)
+        try:
+            self.word_dict.add_words(words, backend=pool)
+            self.assertWordsAligned(words, pool)
+        finally:
+            pool.close()
+
+    def test_sentences(self):
+        # Without the separators, the two lines of "what?is" would shift
+        # the empty output of "---" onto "night"
+        words = [u'---', u'what?is', u'night']
+        backend = SentenceBackend()
+        self.word_dict.add_words(words, backend=backend)
+        self.assertWordsAligned(words, backend)
+
+    def test_joined_lines(self):
+        words = [u'hello', u'mr', u'night', u'rhyme']
+        backend = SentenceBackend()
+        self.word_dict.add_words(words, backend=backend)
+        self.assertWordsAligned(words, backend)
+
+class TranscriptionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_fname = os.path.join(self.tmp_dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_imported_sidecars_are_hit(self):
+        for language in ['en', 'en-us']:
+            n = raplyzer.import_transcriptions(self.cache_fname, 'lyrics_en',
+                                               language=language)
+            self.assertTrue(n > 0)
+            cache = ph.TranscriptionCache(self.cache_fname)
+            song = sorted(raplyzer.list_songs('lyrics_en')[0][1][0][1])[0]
+            prof = profiling.enable()
+            try:
+                l = Lyrics(song, language=language, cache=cache)
+                l.analyze()
+            finally:
+                profiling.disable()
+                cache.close()
+            self.assertEqual(prof.counts.get('transcription_cache_hits'), 1)
+            self.assertEqual(prof.counts.get('transcription_cache_misses'),
+                             None)
+            expected = Lyrics(song, language=language)
+            self.assertEqual(l.text, expected.text)
+
+    def test_language_is_part_of_the_key(self):
+        cache = ph.TranscriptionCache(self.cache_fname)
+        pool = ph.EspeakPool(command=FAKE_ESPEAK)
+        try:
+            text = u'hello there my friend\nsend it to the end'
+            l = Lyrics(text=text, language='en', cache=cache, backend=pool)
+            l.analyze()
+            self.assertNotEqual(cache.get(l.text_orig, 'en'), None)
+            self.assertEqual(cache.get(l.text_orig, 'en-us'), None)
+        finally:
+            pool.close()
+            cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the corpus level functions of raplyzer.
+
+Usage:
+    python -m unittest test_raplyzer
+'''
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import raplyzer
+
+def run_quietly(fn, *args, **kwargs):
+    '''
+    Call fn and return its output to stdout.
+    '''
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        fn(*args, **kwargs)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def bundled_songs(lyrics_dir, n_songs=3):
+    '''
+    The first n_songs songs of a bundled corpus.
+    '''
+    return [file_name for a, albums in raplyzer.list_songs(lyrics_dir)
+            for al, songs in albums for file_name in songs][:n_songs]
+
+def write_corpus(lyrics_dir, n_artists=3, n_songs=10, text=None):
+    '''
+    Write n_songs songs for each of n_artists artists under lyrics_dir.
+    '''
+    for a in range(n_artists):
+        album_dir = os.path.join(lyrics_dir, 'artist%d' % a, 'album')
+        os.makedirs(album_dir)
+        for i in range(n_songs):
+            song = text
+            if song is None:
+                song = 'talo %d palo\nkala %d sala\n' % (i, a)
+            f = open(os.path.join(album_dir, 'song%d.txt' % i), 'w')
+            f.write(song)
+            f.close()
+
+class SongResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lyrics_dir = os.path.join(self.tmp_dir, 'lyrics')
+        self.store_fname = os.path.join(self.tmp_dir, 'results.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        store = raplyzer.SongResultStore(self.store_fname)
+        songs = [(f, 'fi', 10) for f in bundled_songs('lyrics')]
+        songs += [(f, 'en-us', 15) for f in bundled_songs('lyrics_en')]
+        for file_name, language, lookback in songs:
+            res = raplyzer.analyze_song(file_name, language, lookback,
+                                        print_stats=True)
+            content_hash = store.content_hash(file_name, language)
+            store.put(file_name, content_hash, language, lookback, '', res)
+            hashes = {file_name: content_hash}
+            self.assertEqual(store.get_results(hashes, language, lookback),
+                             {file_name: res})
+            # A changed song, other parameters or another variant
+            self.assertEqual(store.get_results({file_name: 'changed'},
+                                               language, lookback), {})
+            self.assertEqual(store.get_results(hashes, language,
+                                               lookback + 1), {})
+            self.assertEqual(store.get_results(hashes, language, lookback,
+                                               'words'), {})
+        store.close()
+
+    def test_prune(self):
+        store = raplyzer.SongResultStore(self.store_fname)
+        res = raplyzer.analyze_song(bundled_songs('lyrics')[0], 'fi', 10)
+        paths = [os.path.join(self.lyrics_dir, 'a', 'song1.txt'),
+                 os.path.join(self.lyrics_dir, 'a', 'song2.txt'),
+                 os.path.join(self.lyrics_dir, 'b', 'song1.txt'),
+                 os.path.join(self.lyrics_dir + '2', 'a', 'song1.txt')]
+        for path in paths:
+            store.put(path, 'hash', 'fi', 10, '', res)
+        hashes = dict((path, 'hash') for path in paths)
+        store.prune(os.path.join(self.lyrics_dir, 'a'), paths[:1])
+        self.assertEqual(sorted(store.get_results(hashes, 'fi', 10)),
+                         sorted([paths[0], paths[2], paths[3]]))
+        store.prune(self.lyrics_dir, [])
+        self.assertEqual(sorted(store.get_results(hashes, 'fi', 10)),
+                         [paths[3]])
+        store.close()
+
+    def test_read_lyrics(self):
+        write_corpus(self.lyrics_dir)
+        for print_stats in [False, True]:
+            expected = run_quietly(raplyzer.read_lyrics, self.lyrics_dir,
+                                   language='fi', lookback=10,
+                                   print_stats=print_stats)
+            # The first run fills the store and the second one reads it
+            for i in range(2):
+                output = run_quietly(raplyzer.read_lyrics, self.lyrics_dir,
+                                     language='fi', lookback=10,
+                                     print_stats=print_stats,
+                                     result_store=self.store_fname)
+                self.assertEqual(output, expected)
+        # A changed song is analyzed again
+        f = open(os.path.join(self.lyrics_dir, 'artist0', 'album',
+                              'song0.txt'), 'w')
+        f.write('talo palo\nkala sala\nmaa taa\n')
+        f.close()
+        expected = run_quietly(raplyzer.read_lyrics, self.lyrics_dir,
+                               language='fi', lookback=10, print_stats=True)
+        output = run_quietly(raplyzer.read_lyrics, self.lyrics_dir,
+                             language='fi', lookback=10, print_stats=True,
+                             result_store=self.store_fname)
+        self.assertEqual(output, expected)
+
+class CorpusResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_shards(self, lyrics_dir, language, lookback, n_shards, shard_by):
+        fnames = []
+        for i in range(n_shards):
+            fname = os.path.join(self.tmp_dir, '%s_%d.json' % (shard_by, i))
+            run_quietly(raplyzer.read_lyrics, lyrics_dir, language=language,
+                        lookback=lookback, shard_file=fname,
+                        shard=(i, n_shards), shard_by=shard_by)
+            fnames.append(fname)
+        return fnames
+
+    def test_shards(self):
+        for lyrics_dir, language, lookback in [('lyrics', 'fi', 10),
+                                               ('lyrics_en', 'en-us', 15)]:
+            fname = os.path.join(self.tmp_dir, 'all.json')
+            expected = run_quietly(raplyzer.read_lyrics, lyrics_dir,
+                                   language=language, lookback=lookback)
+            expected = expected[expected.index('\nBest rhymes'):]
+            run_quietly(raplyzer.read_lyrics, lyrics_dir, language=language,
+                        lookback=lookback, shard_file=fname)
+            single = raplyzer.CorpusResults.load(fname)
+            self.assertEqual(run_quietly(single.print_rankings), expected)
+            for shard_by in ['artist', 'song']:
+                for n_shards in [1, 2, 5]:
+                    fnames = self.run_shards(lyrics_dir, language, lookback,
+                                             n_shards, shard_by)
+                    # The order of the shards doesn't matter
+                    merged = raplyzer.merge_shards(fnames[::-1],
+                                                   print_rankings=False)
+                    self.assertEqual(merged.rankings(), single.rankings())
+                    self.assertEqual(run_quietly(merged.print_rankings),
+                                     expected)
+
+    def test_invalid_merges(self):
+        fnames = self.run_shards('lyrics', 'fi', 10, 3, 'song')
+        self.assertRaisesRegexp(Exception, 'missing', raplyzer.merge_shards,
+                                fnames[:2], False)
+        self.assertRaisesRegexp(Exception, 'common songs',
+                                raplyzer.merge_shards,
+                                fnames + fnames[:1], False)
+        other = os.path.join(self.tmp_dir, 'other.json')
+        run_quietly(raplyzer.read_lyrics, 'lyrics', language='fi',
+                    lookback=5, shard_file=other, shard=(0, 3),
+                    shard_by='song')
+        self.assertRaisesRegexp(Exception, 'different parameters',
+                                raplyzer.merge_shards,
+                                fnames[1:] + [other], False)
+
+class ReadLyricsErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lyrics_dir = os.path.join(self.tmp_dir, 'lyrics')
+        # English songs without transcriptions, which can't be transcribed
+        # without eSpeak
+        write_corpus(self.lyrics_dir, text='hello there\nmy friend\n')
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp_dir
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+    def test_workers_and_readers_are_stopped(self):
+        n_threads = threading.active_count()
+        for workers in [1, 3]:
+            self.assertRaises(Exception, raplyzer.read_lyrics,
+                              self.lyrics_dir, language='en-us',
+                              workers=workers, read_ahead=4)
+            # The reading threads give up within their polling interval
+            for i in range(50):
+                if threading.active_count() == n_threads:
+                    break
+                threading.Event().wait(0.1)
+            self.assertEqual(threading.active_count(), n_threads)
+            self.assertEqual(multiprocessing.active_children(), [])
+
+if __name__ == '__main__':
+    unittest.main()
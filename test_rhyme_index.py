@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the rhyme index. The results of the index must be the longest
+rhymes found by comparing the query to every line (or word) of the corpus.
+
+Usage:
+    python -m unittest test_rhyme_index
+'''
+
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import phonetics as ph
+import raplyzer
+import rhyme_index
+from lyrics import Lyrics
+
+def brute_force_entries(song_lists, language, words=False):
+    '''
+    (song index, word index, line text, word, vowels of the song up to the
+    end of the word) tuples of the line ends (or the word ends).
+    '''
+    entries = []
+    file_names = [file_name for a, albums in song_lists
+                  for al, songs in albums for file_name in songs]
+    for song, file_name in enumerate(file_names):
+        l = Lyrics(file_name, language=language)
+        if language == 'fi':
+            lines = l.text.split('\n')
+        else:
+            # The line of the lyrics with the same index as the line of the
+            # transcription (see rhyme_index.song_lines_text)
+            lines = l.lines_orig + [u''] * len(l.line_starts)
+        line_idxs = rhyme_index.word_lines(l)
+        for w, p in enumerate(l.word_ends):
+            if not words and w+1 < len(l.word_ends) and \
+                    line_idxs[w+1] == line_idxs[w]:
+                continue
+            entries.append((song, w, lines[line_idxs[w]], l.words[w],
+                            l.vow[:p+1]))
+    return entries
+
+def rhyme_length(vow1, vow2, max_length):
+    # Number of equal vowels from the end
+    n = 0
+    while n < min(len(vow1), len(vow2), max_length) and \
+            vow1[-1-n] == vow2[-1-n]:
+        n += 1
+    return n
+
+class RhymeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_queries(self, lyrics_dir, language, queries, max_length=16,
+                      words=False, k=10, min_length=2, **lyrics_args):
+        song_lists = raplyzer.list_songs(lyrics_dir)
+        n_entries = rhyme_index.write_index(self.tmp_dir, song_lists,
+                                            language, max_length, words)
+        entries = brute_force_entries(song_lists, language, words)
+        index = rhyme_index.RhymeIndex(self.tmp_dir)
+        self.assertEqual(n_entries, len(entries))
+        self.assertEqual(len(index), len(entries))
+        filenames = [s['filename'] for s in index.songs]
+        lines = dict(((song, w), line) for song, w, line, word, vow
+                     in entries)
+        # Every entry gives the line of its own song
+        for i in range(len(index)):
+            res = index._result(i, 0)
+            self.assertEqual(res['text'],
+                             lines[filenames.index(res['song']), res['word']])
+        for query in queries:
+            results = index.query(query, k, min_length, **lyrics_args)
+            l = Lyrics(text=query, language=language, **lyrics_args)
+            if len(l.word_ends) == 0:
+                self.assertEqual(results, [])
+                continue
+            query_vow = l.vow[:l.word_ends[-1]+1]
+            lengths = {}
+            for song, w, line, word, vow in entries:
+                if word != l.words[-1]:
+                    lengths[song, w] = (rhyme_length(query_vow, vow,
+                                                     max_length), line)
+            expected = sorted([n for n, line in lengths.values()
+                               if n >= min_length], reverse=True)[:k]
+            self.assertEqual([r['length'] for r in results], expected, query)
+            for r in results:
+                song = filenames.index(r['song'])
+                self.assertEqual((r['length'], r['text']),
+                                 lengths[song, r['word']], query)
+
+    def test_lines(self):
+        song_lists = raplyzer.list_songs('lyrics')
+        rng = random.Random(0)
+        queries = [u'', u'!', u'talo', u'kaupunki on kaunis']
+        for a, albums in song_lists:
+            for al, songs in albums:
+                for file_name in songs:
+                    lines = Lyrics(file_name, language='fi').text.split('\n')
+                    queries += rng.sample(lines, min(len(lines), 5))
+        self.check_queries('lyrics', 'fi', queries)
+        self.check_queries('lyrics', 'fi', queries[:20], max_length=4,
+                           min_length=1, k=3)
+
+    def test_words(self):
+        self.check_queries('lyrics', 'fi', [u'talo', u'kaupunki', u'räppi'],
+                           words=True, k=50)
+
+    def test_english(self):
+        # The queries are transcribed by the fake eSpeak, so some of their
+        # vowels are not in the corpus
+        pool = ph.EspeakPool(command=[sys.executable, 'fake_espeak.py'])
+        try:
+            self.check_queries('lyrics_en', 'en-us',
+                               [u'hello there', u'in the city tonight',
+                                u'flow'], backend=pool)
+        finally:
+            pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of VocabularyCounter. The counts must be the same as those computed
+from the list of all the tokens, also when the tokens are split into parts
+which are counted separately and combined with extend.
+
+Usage:
+    python -m unittest test_vocabulary
+'''
+
+import json
+import random
+import unittest
+
+from vocabulary import VocabularyCounter
+
+def random_tokens(rng, n_tokens, vocabulary=50):
+    return [u'w%d' % int(rng.paretovariate(1.0) * vocabulary / 10)
+            for i in range(n_tokens)]
+
+def brute_force(tokens, max_words, n=None):
+    '''
+    Number of tokens, unique words and words occurring once among the first
+    n of the first max_words tokens.
+    '''
+    tokens = tokens[:max_words]
+    if n is not None:
+        tokens = tokens[:n]
+    counts = {}
+    for w in tokens:
+        counts[w] = counts.get(w, 0) + 1
+    return (len(tokens), len(counts),
+            sum(1 for c in counts.values() if c == 1))
+
+def split(rng, tokens, n_parts):
+    cuts = sorted(rng.randint(0, len(tokens)) for i in range(n_parts - 1))
+    return [tokens[i:j] for i, j in zip([0] + cuts, cuts + [len(tokens)])]
+
+class VocabularyCounterTest(unittest.TestCase):
+
+    def assertCounts(self, v, tokens):
+        for n in [None, 0, 1, 7, 100, v.n_words, v.max_words + 5]:
+            n_words, n_unique, n_hapax = brute_force(tokens, v.max_words, n)
+            self.assertEqual(v.n_unique(n), n_unique)
+            self.assertEqual(v.n_hapax(n), n_hapax)
+            if n is None:
+                self.assertEqual(v.n_words, n_words)
+                self.assertEqual(v.is_full(), n_words == v.max_words)
+            # No ratio if there are fewer tokens
+            ttr = None
+            if n_words > 0 and (n is None or n <= v.n_words):
+                ttr = float(n_unique) / n_words
+            self.assertEqual(v.ttr(n), ttr)
+
+    def test_add(self):
+        rng = random.Random(0)
+        for i in range(200):
+            tokens = random_tokens(rng, rng.randint(0, 300))
+            v = VocabularyCounter(rng.choice([1, 10, 100, 1000]))
+            for part in split(rng, tokens, rng.randint(1, 10)):
+                v.add(part)
+            self.assertCounts(v, tokens)
+
+    def test_extend(self):
+        rng = random.Random(1)
+        for i in range(200):
+            tokens = random_tokens(rng, rng.randint(0, 300))
+            max_words = rng.choice([1, 10, 100, 1000])
+            v = VocabularyCounter(max_words)
+            for part in split(rng, tokens, rng.randint(1, 10)):
+                other = VocabularyCounter(max_words)
+                other.add(part)
+                v.extend(other)
+            self.assertCounts(v, tokens)
+            expected = VocabularyCounter(max_words)
+            expected.add(tokens)
+            self.assertEqual(v.to_dict(), expected.to_dict())
+
+    def test_round_trip(self):
+        rng = random.Random(2)
+        for i in range(50):
+            tokens = random_tokens(rng, rng.randint(0, 300))
+            v = VocabularyCounter(rng.choice([10, 100, 1000]))
+            v.add(tokens)
+            # As stored by raplyzer.CorpusResults
+            loaded = VocabularyCounter.from_dict(
+                    json.loads(json.dumps(v.to_dict())))
+            self.assertEqual(loaded.summary(), v.summary())
+            self.assertCounts(loaded, tokens)
+            # Adding to the loaded counter
+            more = random_tokens(rng, 50)
+            loaded.add(more)
+            self.assertCounts(loaded, tokens + more)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+'''
+Vocabulary richness of an artist (or an album, a corpus...) computed from
+the first max_words word tokens. The tokens are consumed incrementally and
+only the positions of the first and the second occurrence of each word are
+kept, so the memory usage depends on the size of the vocabulary and not on
+the number of tokens.
+
+The counters of consecutive parts of the tokens (e.g. songs or shards
+analyzed in parallel) can be combined with extend, which gives the same
+result as adding all the tokens to a single counter.
+
+Usage:
+    v = VocabularyCounter(20000)
+    for song in songs:
+        v.add(song.get_words())
+    print v.n_unique(), v.n_hapax(), v.ttr(10000)
+'''
+
+# Numbers of tokens at which the type-token ratios are reported by summary
+TTR_CHECKPOINTS = (1000, 5000, 10000, 20000)
+
+class VocabularyCounter:
+    '''
+    Counts the words among the first max_words tokens added.
+    '''
+
+    def __init__(self, max_words=20000):
+        self.max_words = max_words
+        # Number of tokens taken into account (at most max_words)
+        self.n_words = 0
+        # Word -> position of its first occurrence
+        self.first = {}
+        # Word -> position of its second occurrence
+        self.second = {}
+
+    def is_full(self):
+        return self.n_words >= self.max_words
+
+    def add(self, words):
+        '''
+        Add the next tokens. The tokens after the first max_words are
+        ignored.
+        '''
+        n = self.n_words
+        words = words[:self.max_words - n]
+        first = self.first
+        second = self.second
+        for pos, w in enumerate(words, n):
+            if w not in first:
+                first[w] = pos
+            elif w not in second:
+                second[w] = pos
+        self.n_words = n + len(words)
+
+    def extend(self, other):
+        '''
+        Add the tokens of another counter as if they were added after the
+        tokens of this counter.
+        '''
+        offset = self.n_words
+        room = self.max_words - offset
+        first = self.first
+        second = self.second
+        for w, pos in other.first.iteritems():
+            if pos >= room:
+                continue
+            if w not in first:
+                first[w] = pos + offset
+                pos2 = other.second.get(w)
+                if pos2 is not None and pos2 < room:
+                    second[w] = pos2 + offset
+            elif w not in second:
+                second[w] = pos + offset
+        self.n_words = offset + min(other.n_words, room)
+
+    def n_unique(self, n=None):
+        '''
+        Number of unique words among the first n tokens (default: all the
+        tokens taken into account).
+        '''
+        if n is None or n >= self.n_words:
+            return len(self.first)
+        return sum(1 for pos in self.first.itervalues() if pos < n)
+
+    def n_hapax(self, n=None):
+        '''
+        Number of words occurring exactly once among the first n tokens.
+        '''
+        if n is None or n >= self.n_words:
+            return len(self.first) - len(self.second)
+        return self.n_unique(n) - sum(1 for pos in self.second.itervalues()
+                                      if pos < n)
+
+    def ttr(self, n=None):
+        '''
+        Type-token ratio of the first n tokens (None if there are fewer
+        tokens).
+        '''
+        if n is None:
+            n = self.n_words
+        if n > self.n_words or n == 0:
+            return None
+        return float(self.n_unique(n)) / n
+
+    def summary(self, checkpoints=TTR_CHECKPOINTS):
+        '''
+        Output:
+            Dict with keys n_words, n_unique, n_hapax and ttr (list of
+            (number of tokens, type-token ratio) tuples for the checkpoints
+            reached).
+        '''
+        return {'n_words': self.n_words,
+                'n_unique': self.n_unique(),
+                'n_hapax': self.n_hapax(),
+                'ttr': [(n, self.ttr(n)) for n in checkpoints
+                        if n <= self.n_words]}
+
+    def to_dict(self):
+        return {'max_words': self.max_words, 'n_words': self.n_words,
+                'first': self.first, 'second': self.second}
+
+    @staticmethod
+    def from_dict(data):
+        v = VocabularyCounter(data['max_words'])
+        v.n_words = data['n_words']
+        v.first = dict(data['first'])
+        v.second = dict(data['second'])
+        return v